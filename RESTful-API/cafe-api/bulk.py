@@ -0,0 +1,119 @@
+import json
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+
+
+ON_CONFLICT = ("skip", "update")
+
+TEXT_FIELDS = ("name", "map_url", "img_url", "location", "seats")
+BOOLEAN_FIELDS = ("has_toilet", "has_wifi", "has_sockets", "can_take_calls")
+TRUE_VALUES = (True, 1, "1", "true", "True", "yes")
+FALSE_VALUES = (False, 0, "0", "false", "False", "no")
+
+
+# Validation
+def parse_cafe(data, optional=()):
+    # the values of one cafe, ready for the cafe table - raises ValueError when invalid.
+    # The text fields in optional may be empty.
+    if isinstance(data, InvalidLine):
+        raise ValueError(data.message)
+    if not isinstance(data, dict):
+        raise ValueError("A cafe must be a JSON object.")
+
+    cafe = {}
+    for field in TEXT_FIELDS:
+        value = data.get(field)
+        if not isinstance(value, str) or not (value.strip() or field in optional):
+            raise ValueError(f"{field} is missing.")
+        cafe[field] = value.strip()
+    for field in BOOLEAN_FIELDS:
+        value = data.get(field)
+        if value in TRUE_VALUES:
+            cafe[field] = True
+        elif value in FALSE_VALUES:
+            cafe[field] = False
+        else:
+            raise ValueError(f"{field} must be true or false.")
+
+    price = data.get("coffee_price")
+    cafe["coffee_price"] = None if price in (None, "") else str(price)
+    for field in ("lat", "lng"):
+        value = data.get(field)
+        try:
+            cafe[field] = None if value in (None, "") else float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"{field} must be a number.")
+    return cafe
+
+
+# Reading the request body
+def iter_json_array(stream):
+    data = json.load(stream)
+    if not isinstance(data, list):
+        raise ValueError("The body must be a JSON array of cafes.")
+    yield from data
+
+
+# A line of an NDJSON body that isn't valid JSON - reported as an invalid row
+class InvalidLine:
+    def __init__(self, line_number, error):
+        if isinstance(error, json.JSONDecodeError):
+            self.message = f"Line {line_number} is not valid JSON: {error.msg} (column {error.colno})."
+        else:
+            self.message = f"Line {line_number} is not valid JSON: {error}."
+
+
+def iter_ndjson(stream):
+    # one cafe per line, read as the body arrives
+    for line_number, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as error:  # JSONDecodeError, or bytes that aren't UTF-8
+                yield InvalidLine(line_number, error)
+
+
+# coffee-and-wifi's cafe-data.csv: Cafe Name,Location,Open,Close,Coffee,Wifi,Power -
+# Location is a maps link and the ratings are emoji ("💪💪", "🔌🔌🔌", or "✘" for none).
+# It has no picture, area or seats and says nothing about toilets and calls.
+# Those cafes are stored with empty fields, so the files of the import command
+# (which may be exports of such cafes) can leave them empty too.
+IMPORT_OPTIONAL_FIELDS = ("img_url", "location", "seats")
+
+
+def coffee_and_wifi_cafe(row):
+    # a row of cafe-data.csv as the fields of parse_cafe(row, IMPORT_OPTIONAL_FIELDS)
+    return {
+        "name": row.get("Cafe Name"),
+        "map_url": row.get("Location"),
+        "img_url": "",
+        "location": "",
+        "seats": "",
+        "has_toilet": False,
+        "has_wifi": "💪" in (row.get("Wifi") or ""),
+        "has_sockets": "🔌" in (row.get("Power") or ""),
+        "can_take_calls": False,
+        "coffee_price": None,
+    }
+
+
+# Writing
+def insert_chunk(connection, table, cafes, on_conflict="skip"):
+    # inserts the cafes with one executemany and returns the stored rows by name
+    # (cafes skipped because of a name that already exists are missing).
+    statement = insert(table)
+    if on_conflict == "skip":
+        statement = statement.on_conflict_do_nothing(index_elements=["name"])
+    elif on_conflict == "update":
+        statement = statement.on_conflict_do_update(
+            index_elements=["name"],
+            set_={column: statement.excluded[column] for column in cafes[0] if column != "name"},
+        )
+    result = connection.execute(statement.returning(*table.columns), cafes)
+    return {row.name: row for row in result}
+
+
+def existing_ids(connection, table, names):
+    # name -> id of the cafes that are already stored
+    return dict(connection.execute(select(table.c.name, table.c.id).where(table.c.name.in_(names))).all())
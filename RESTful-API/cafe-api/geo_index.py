@@ -0,0 +1,184 @@
+import heapq
+import math
+import re
+import threading
+
+from sqlalchemy import select
+
+from shared.table_versions import table_version
+
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# Google Maps links carry the coordinates as "!3d<lat>!4d<lng>" (the place itself)
+# or "@<lat>,<lng>" (the center of the map) - short links (goo.gl, g.page) carry none.
+COORDINATE_PATTERNS = [
+    re.compile(r'!3d(-?\d+(?:\.\d+)?)!4d(-?\d+(?:\.\d+)?)'),
+    re.compile(r'@(-?\d+(?:\.\d+)?),(-?\d+(?:\.\d+)?)'),
+    re.compile(r'[?&](?:q|ll|query)=(-?\d+(?:\.\d+)?),(-?\d+(?:\.\d+)?)'),
+]
+
+
+def parse_coordinates(map_url):
+    for pattern in COORDINATE_PATTERNS:
+        match = pattern.search(map_url or "")
+        if match:
+            lat, lng = float(match.group(1)), float(match.group(2))
+            if -90 <= lat <= 90 and -180 <= lng <= 180:
+                return lat, lng
+    return None
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+# Grid of square cells (cell_size degrees wide, ~1 km by default) holding the cafes located in them.
+# A k-nearest query looks at the cell of the point and then at rings of cells
+# around it, and stops as soon as every cafe outside the rings seen so far must be
+# farther away than the k-th nearest one found - so only the cells close to the
+# point are visited, whatever the size of the table.
+# The grid is built on the first query and kept up to date by the write routes.
+# Like SearchIndex it remembers the version of the table it was built from (see
+# shared/table_versions.py); a query that sees a newer version - a write of
+# another process or of the CLI - builds the grid again first.
+class GeoIndex:
+    def __init__(self, model, cell_size=0.01):
+        self.model = model
+        self.cell_size = cell_size
+        self.cells = {}  # (row, column) -> {id: (lat, lng)}
+        self.cell_of = {}  # id -> (row, column)
+        self.version = None
+        self.ready = False
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()  # one rebuild at a time
+
+    def cell(self, lat, lng):
+        return math.floor(lat / self.cell_size), math.floor(lng / self.cell_size)
+
+    def coordinates(self, lat, lng, map_url):
+        if lat is not None and lng is not None:
+            return lat, lng
+        return parse_coordinates(map_url)
+
+    # Building the index
+    def load(self, engine, batch_size=10000):
+        # builds a new grid while the old one still answers, then swaps them
+        model = self.model
+        grid = GeoIndex(model, self.cell_size)
+        with engine.connect() as connection:
+            # read before the rows: a write in between makes the grid look older, never newer
+            version = table_version(connection, model.__tablename__)
+            result = connection.execution_options(yield_per=batch_size).execute(
+                select(model.id, model.lat, model.lng, model.map_url)
+            )
+            for partition in result.partitions():
+                for row_id, lat, lng, map_url in partition:
+                    grid.insert(row_id, self.coordinates(lat, lng, map_url))
+        with self.lock:
+            self.cells, self.cell_of, self.version = grid.cells, grid.cell_of, version
+            self.ready = True
+
+    def ensure_loaded(self, engine, version=None):
+        # version: the current version of the table
+        if not self.stale(version):
+            return
+        with self.load_lock:
+            if self.stale(version):  # not rebuilt by another request meanwhile
+                self.load(engine)
+
+    def stale(self, version):
+        return not self.ready or (version is not None and version > self.version)
+
+    # Incremental maintenance (called by the write routes)
+    # version: the version of the table right after a write of one row, if known
+    def add(self, row, version=None):
+        with self.lock:
+            if self.ready:
+                self.insert(row.id, self.coordinates(row.lat, row.lng, row.map_url))
+                self.move_to(version)
+
+    def remove(self, row_id, version=None):
+        with self.lock:
+            if self.ready:
+                self.delete(row_id)
+                self.move_to(version)
+
+    def move_to(self, version, changes=1):
+        # writes made while the grid was rebuilt are missing from the new grid, whose
+        # version is then too old to move forward - the next query rebuilds it
+        if version is not None and self.ready and self.version == version - changes:
+            self.version = version
+
+    def synced(self, version, changes):
+        # the writes of this process that brought the table to version (changes rows,
+        # each applied with version=None) are in the index
+        with self.lock:
+            self.move_to(version, changes)
+
+    def insert(self, row_id, coordinates):
+        self.delete(row_id)
+        if coordinates is None:  # the cafe can't be placed on the map
+            return
+        cell = self.cell(*coordinates)
+        self.cells.setdefault(cell, {})[row_id] = coordinates
+        self.cell_of[row_id] = cell
+
+    def delete(self, row_id):
+        cell = self.cell_of.pop(row_id, None)
+        if cell is not None:
+            del self.cells[cell][row_id]
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    # Searching
+    def nearest(self, lat, lng, k):
+        # returns [(distance in km, id)] of the k nearest cafes, nearest first
+        with self.lock:
+            center_row, center_column = self.cell(lat, lng)
+            nearest = []  # max heap (negative distances) of the best k so far
+            ring = 0
+            while True:
+                if (2 * ring + 1) ** 2 >= len(self.cells):
+                    # the rings cover more cells than there are non-empty cells
+                    # (a point far from every cafe) - cheaper to look at the remaining cells directly.
+                    cells = [cell for cell in self.cells
+                             if max(abs(cell[0] - center_row), abs(cell[1] - center_column)) >= ring]
+                    self.collect(cells, lat, lng, k, nearest)
+                    break
+
+                self.collect(self.ring_cells(center_row, center_column, ring), lat, lng, k, nearest)
+                if len(nearest) == k and -nearest[0][0] <= self.min_distance_outside(lat, ring):
+                    break
+                ring += 1
+
+        return sorted((-distance, row_id) for distance, row_id in nearest)
+
+    def ring_cells(self, center_row, center_column, ring):
+        if ring == 0:
+            return [(center_row, center_column)]
+        cells = []
+        for offset in range(-ring, ring + 1):
+            cells += [(center_row - ring, center_column + offset), (center_row + ring, center_column + offset)]
+        for offset in range(-ring + 1, ring):
+            cells += [(center_row + offset, center_column - ring), (center_row + offset, center_column + ring)]
+        return cells
+
+    def min_distance_outside(self, lat, ring):
+        # lower bound of the distance from the point to any cell beyond <ring>.
+        # The point may be anywhere in its own cell, so only 'ring' full cells separate them.
+        degrees = ring * self.cell_size
+        farthest_lat = min(abs(lat) + degrees, 90.0)
+        return degrees * KM_PER_DEGREE * math.cos(math.radians(farthest_lat))
+
+    def collect(self, cells, lat, lng, k, nearest):
+        for cell in cells:
+            for row_id, (cafe_lat, cafe_lng) in self.cells.get(cell, {}).items():
+                distance = haversine_km(lat, lng, cafe_lat, cafe_lng)
+                if len(nearest) < k:
+                    heapq.heappush(nearest, (-distance, row_id))
+                elif distance < -nearest[0][0]:
+                    heapq.heapreplace(nearest, (-distance, row_id))
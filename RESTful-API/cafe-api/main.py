@@ -1,18 +1,47 @@
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, jsonify, render_template, request, Response, stream_with_context
+from flask.cli import AppGroup
 from flask_bootstrap import Bootstrap
+import click
 
 import sqlalchemy
-from sqlalchemy import create_engine, Column, Integer, String, Boolean
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, String, Boolean, Float, Index, select, text
 
-import random
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))  # repository root, for the shared modules
+from shared.database import create_sqlite_engine, init_session
+from shared.instrumentation import init_instrumentation
+from shared.table_versions import create_table_versions, table_version
+from shared import bulk_io
+
+from random_index import RandomIndex
+from search_index import SearchIndex
+from geo_index import GeoIndex
+import bulk
+from response_cache import ResponseCache
+from serializers import RowSerializer
+
+MAX_RANDOM_SAMPLE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+# /search query parameter -> Cafe column
+AMENITY_FILTERS = {
+    "wifi": "has_wifi",
+    "sockets": "has_sockets",
+    "toilet": "has_toilet",
+    "calls": "can_take_calls",
+}
+CAFE_FIELDS = ("id", "name", "map_url", "img_url", "location", "seats",
+               "has_toilet", "has_wifi", "has_sockets", "can_take_calls", "coffee_price")
+DEFAULT_NEARBY = 5
+MAX_NEARBY = 50
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 Bootstrap(app)
 
 # Create DataBase
-engine = create_engine('sqlite:///RESTful-API/cafe-api/cafes.db')
+engine = create_sqlite_engine('sqlite:///RESTful-API/cafe-api/cafes.db')
 Base = sqlalchemy.orm.declarative_base()
 
 # Note - We can see the DB in the DB Browser of "SQLite" that installed on our computer:
@@ -32,11 +61,45 @@ class Cafe(Base):
     has_sockets = Column(Boolean, nullable=False)
     can_take_calls = Column(Boolean, nullable=False)
     coffee_price = Column(String(100), nullable=True)
+    # when empty, the coordinates are read from map_url (if it has them)
+    lat = Column(Float, nullable=True)
+    lng = Column(Float, nullable=True)
+
+    __table_args__ = (
+        Index('ix_cafe_location', text('location COLLATE NOCASE')),
+    )
 
 Base.metadata.create_all(engine)
+# create_all() skips existing tables, so add the new columns and indexes to an older cafes.db here.
+existing_columns = [column['name'] for column in sqlalchemy.inspect(engine).get_columns(Cafe.__tablename__)]
+with engine.begin() as connection:
+    for column in ('lat', 'lng'):
+        if column not in existing_columns:
+            connection.execute(text(f"ALTER TABLE {Cafe.__tablename__} ADD COLUMN {column} FLOAT"))
+for index in Cafe.__table__.indexes:
+    index.create(engine, checkfirst=True)
+# version of the cafe table, bumped by every write - lets each worker notice the writes of the others
+create_table_versions(engine, Cafe.__tablename__)
+
+session = init_session(app, engine)
+init_instrumentation(app, engine)  # request timing, SQL statement counts and /metrics
 
-Session = sessionmaker(bind=engine)
-session = Session()
+# ids of all the cafes, for picking a random cafe without loading the table.
+random_index = RandomIndex(Cafe)
+random_index.load_in_background(engine)
+
+# bitsets of the cafes by location and amenities, for /search.
+search_index = SearchIndex(Cafe, AMENITY_FILTERS)
+search_index.load_in_background(engine)
+
+# grid of the cafe coordinates, for /nearby - built on the first query.
+geo_index = GeoIndex(Cafe)
+
+# the fields sent for a cafe, read with a column projection instead of ORM objects.
+cafe_serializer = RowSerializer(Cafe.__table__, CAFE_FIELDS)
+
+# serialized responses of the read routes, dropped by every write to the cafe table.
+response_cache = ResponseCache(version=lambda table: table_version(session, table))
 
 
 # HTTP GET
@@ -46,28 +109,145 @@ def home():
     
 @app.route("/random")
 def get_random_cafe():
-    cafes = session.query(Cafe).all()
-    random_cafe = random.choice(cafes)
-    return to_dict(random_cafe)
+    # http://127.0.0.1:5000/random?n=<number of distinct cafes>
+    n = request.args.get('n', '1')
+    if not n.isdigit() or not 1 <= int(n) <= MAX_RANDOM_SAMPLE:
+        return jsonify(
+            response={
+                "error": f"n must be a number between 1 and {MAX_RANDOM_SAMPLE}."
+            }
+        ), 400
+
+    cafes = random_cafes(int(n))
+
+    if 'n' in request.args:
+        return Response(b'{"cafes_list": [' + b", ".join(cafes) + b"]}\n", mimetype='application/json')
+    if not cafes:
+        return jsonify(
+            response={
+                "error": "There are no cafes in the database."
+            }
+        ), 404
+    return Response(cafes[0], mimetype='application/json')
 
 @app.route("/all")
+@response_cache.cached(Cafe.__tablename__)
 def get_all_cafes():
-    cafes = session.query(Cafe).all()
-    return jsonify(cafes_list = [to_dict(cafe) for cafe in cafes])
+    # http://127.0.0.1:5000/all?limit=<page size>&after=<last id of the previous page>
+    # http://127.0.0.1:5000/all?format=ndjson
+    # http://127.0.0.1:5000/all?fields=<comma separated fields>
+    limit = request.args.get('limit')
+    after = request.args.get('after', '0')
+    output_format = request.args.get('format', 'json')
+
+    if not after.isdigit():
+        return jsonify(
+            response={
+                "error": "after must be the id of a cafe."
+            }
+        ), 400
+    try:
+        fields = cafe_serializer.parse_fields(request.args.get('fields'))
+    except ValueError as error:
+        return jsonify(response={"error": str(error)}), 400
+
+    if limit is not None:
+        if not limit.isdigit() or not 1 <= int(limit) <= MAX_PAGE_SIZE:
+            return jsonify(
+                response={
+                    "error": f"limit must be a number between 1 and {MAX_PAGE_SIZE}."
+                }
+            ), 400
+        # keyset pagination - continue right after the last id of the previous page
+        statement = cafe_serializer.select(fields).add_columns(Cafe.id)  # the id (last) is ignored by to_dicts
+        cafes = session.execute(statement.where(Cafe.id > int(after)).order_by(Cafe.id).limit(int(limit))).all()
+        next_after = cafes[-1][-1] if len(cafes) == int(limit) else None
+        return jsonify(cafes_list = cafe_serializer.to_dicts(cafes, fields), next_after = next_after)
+
+    # no limit - stream the whole table in batches instead of building one big list
+    if output_format == 'ndjson':
+        return Response(stream_with_context(stream_ndjson(int(after), fields)), mimetype='application/x-ndjson')
+    return Response(stream_with_context(stream_json(int(after), fields)), mimetype='application/json')
 
 @app.route("/search")
+@response_cache.cached(Cafe.__tablename__)
 def get_cafes_by_area():
-    # http://127.0.0.1:5000/search?area=<value>
+    # http://127.0.0.1:5000/search?area=<value>&wifi=1&sockets=1&toilet=0&calls=1&fields=<comma separated fields>
     area = request.args.get('area')
+    try:
+        fields = cafe_serializer.parse_fields(request.args.get('fields'))
+    except ValueError as error:
+        return jsonify(response={"error": str(error)}), 400
 
-    cafes = session.query(Cafe).filter_by(location=f"{area}").all()
+    filters = {}
+    for name in AMENITY_FILTERS:
+        value = request.args.get(name)
+        if value is None:
+            continue
+        if value.lower() not in ("1", "true", "0", "false"):
+            return jsonify(
+                response={
+                    "error": f"{name} must be 1/true or 0/false."
+                }
+            ), 400
+        filters[name] = value.lower() in ("1", "true")
+
+    if area is None and not filters:
+        return jsonify(
+            response={
+                "error": "Search by area and/or by " + ", ".join(AMENITY_FILTERS) + "."
+            }
+        ), 400
+
+    version = response_cache.generation(Cafe.__tablename__)
+    cafes = search_index.search(session, cafe_serializer.select(fields), area, filters, version)
     if cafes == []:
         return {
             "error": {
                 "Not Found": "Sorry, we do not have a cafe at that location."
             }
         }
-    return jsonify(cafes_list = [to_dict(cafe) for cafe in cafes])
+    return jsonify(cafes_list = cafe_serializer.to_dicts(cafes, fields))
+
+@app.route("/nearby")
+@response_cache.cached(Cafe.__tablename__)
+def get_nearby_cafes():
+    # http://127.0.0.1:5000/nearby?lat=<latitude>&lng=<longitude>&k=<number of cafes>&fields=<comma separated fields>
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    k = request.args.get('k', str(DEFAULT_NEARBY))
+
+    if lat is None or lng is None or not -90 <= lat <= 90 or not -180 <= lng <= 180:
+        return jsonify(
+            response={
+                "error": "lat and lng must be valid coordinates."
+            }
+        ), 400
+    if not k.isdigit() or not 1 <= int(k) <= MAX_NEARBY:
+        return jsonify(
+            response={
+                "error": f"k must be a number between 1 and {MAX_NEARBY}."
+            }
+        ), 400
+    try:
+        fields = cafe_serializer.parse_fields(request.args.get('fields'))
+    except ValueError as error:
+        return jsonify(response={"error": str(error)}), 400
+
+    geo_index.ensure_loaded(engine, response_cache.generation(Cafe.__tablename__))
+    nearest = geo_index.nearest(lat, lng, int(k))
+    statement = cafe_serializer.select(fields).add_columns(Cafe.id)
+    rows = session.execute(statement.where(Cafe.id.in_([cafe_id for _, cafe_id in nearest]))).all()
+    cafes = {row[-1]: cafe for row, cafe in zip(rows, cafe_serializer.to_dicts(rows, fields))}
+    cafes_list = []
+    for distance, cafe_id in nearest:
+        if cafe_id in cafes:
+            cafes_list.append({**cafes[cafe_id], "distance_km": round(distance, 3)})
+    return jsonify(cafes_list = cafes_list)
+
+@app.route("/cache-stats")
+def get_cache_stats():
+    return jsonify(response_cache.stats())
 
 
 # HTTP POST
@@ -83,11 +263,17 @@ def add_new_cafe():
         has_wifi = request.form.get("has_wifi"),
         has_sockets = request.form.get("has_sockets"),
         can_take_calls = request.form.get("can_take_calls"),
-        coffee_price = request.form.get("coffee_price")
+        coffee_price = request.form.get("coffee_price"),
+        lat = request.form.get("lat", type=float),
+        lng = request.form.get("lng", type=float)
     )
 
     session.add(new_cafe)
-    session.commit()
+    version = commit_cafes()
+    response_cache.invalidate(Cafe.__tablename__)
+    random_index.add(new_cafe.id, version)
+    search_index.add(new_cafe, version)
+    geo_index.add(new_cafe, version)
 
     return jsonify(
         response={
@@ -95,6 +281,78 @@ def add_new_cafe():
         }
     )
 
+@app.route("/bulk-add", methods=["POST"])
+def bulk_add_cafes():
+    # body: a JSON array of cafes, or one cafe per line with Content-Type: application/x-ndjson
+    # http://127.0.0.1:5000/bulk-add?on_conflict=<skip|update>
+    on_conflict = request.args.get('on_conflict', 'skip')
+    if on_conflict not in bulk.ON_CONFLICT:
+        return jsonify(
+            response={
+                "error": "on_conflict must be one of: " + ", ".join(bulk.ON_CONFLICT) + "."
+            }
+        ), 400
+
+    if request.mimetype == 'application/x-ndjson':
+        rows = bulk.iter_ndjson(request.stream)
+    else:
+        rows = bulk.iter_json_array(request.stream)
+
+    results = []
+    counts = bulk_io.import_counts()
+    try:
+        for chunk in bulk_io.chunks(enumerate(rows)):
+            chunk_results = []
+            valid = []
+            for row_number, data in chunk:
+                try:
+                    valid.append((row_number, bulk.parse_cafe(data)))
+                except ValueError as error:
+                    chunk_results.append({"row": row_number, "status": "invalid", "error": str(error)})
+                    counts["invalid"] += 1
+
+            if valid:
+                # one transaction and one executemany per chunk
+                with engine.begin() as connection:
+                    existing = bulk.existing_ids(connection, Cafe.__table__, [cafe["name"] for _, cafe in valid])
+                    stored = bulk.insert_chunk(connection, Cafe.__table__, [cafe for _, cafe in valid], on_conflict)
+                    # every stored row bumped the version once (a name repeated in the chunk is
+                    # counted once, so the indexes then rebuild instead)
+                    version = table_version(connection, Cafe.__tablename__)
+                response_cache.invalidate(Cafe.__tablename__)
+
+            for row_number, cafe in valid:
+                name = cafe["name"]
+                if name in existing:
+                    status = "updated" if on_conflict == "update" else "skipped"
+                else:
+                    status = "created"
+                    existing[name] = stored[name].id  # the same name again in this request is a conflict
+                chunk_results.append({"row": row_number, "status": status, "id": existing[name]})
+                counts[status] += 1
+                if status == "created":
+                    random_index.add(existing[name])
+                    search_index.add(stored[name])
+                    geo_index.add(stored[name])
+                elif status == "updated":
+                    search_index.update(stored[name])
+                    geo_index.add(stored[name])
+
+            if valid:
+                for index in (random_index, search_index, geo_index):
+                    index.synced(version, len(stored))
+            results += sorted(chunk_results, key=lambda result: result["row"])
+    except ValueError as error:  # the body is not a JSON array
+        return jsonify(response={"error": str(error)}), 400
+
+    return jsonify(
+        response={
+            "success": "Successfully processed the cafes.",
+            **counts
+        },
+        results=results
+    )
+
 
 # HTTP PUT/PATCH 
 @app.route("/update-price/<int:id>", methods=["PATCH"])
@@ -104,7 +362,11 @@ def update_price(id):
 
     if cafe:
         cafe.coffee_price = new_price
-        session.commit()
+        version = commit_cafes()
+        response_cache.invalidate(Cafe.__tablename__)
+        search_index.update(cafe, version)
+        geo_index.add(cafe, version)  # the coordinates are the same, but the version moves on
+        random_index.add(cafe.id, version)
 
         return jsonify(
             response={
@@ -129,7 +391,11 @@ def delete_cafe(id):
     if api_key == "TopSecretAPIKey":
         if cafe:
             session.delete(cafe)
-            session.commit()
+            version = commit_cafes()
+            response_cache.invalidate(Cafe.__tablename__)
+            random_index.remove(id, version)
+            search_index.remove(id, version)
+            geo_index.remove(id, version)
 
             return jsonify(
                 response={
@@ -152,6 +418,64 @@ def delete_cafe(id):
 
 
 # General methods
+def commit_cafes():
+    # commits the session and returns the version of the cafe table right after its write
+    session.flush()
+    version = table_version(session, Cafe.__tablename__)
+    session.commit()
+    return version
+
+def random_cafes(n, max_rounds=3):
+    # JSON of n distinct random cafes (fewer if the table is smaller)
+    version = response_cache.generation(Cafe.__tablename__)
+    for _ in range(max_rounds):
+        ids = random_index.sample_ids(n, version)
+        if not ids:  # the index is still loading, or empty while another process may have added cafes
+            break
+        cafes = serialized_cafes(ids)
+        if len(cafes) == len(ids):
+            return list(cafes.values())
+        # cafes deleted by another process (or the CLI) - drop them from the index and sample again
+        for cafe_id in ids:
+            if cafe_id not in cafes:
+                random_index.remove(cafe_id)
+    return [app.json.dumps(to_dict(cafe)).encode() for cafe in random_index.probe(session, n)]
+
+def serialized_cafes(ids):
+    # JSON of each cafe that still exists (id -> body), from the response cache when possible
+    generation = response_cache.generation(Cafe.__tablename__)
+    cafes = {}
+    for cafe_id in ids:
+        entry = response_cache.get(("cafe", cafe_id), Cafe.__tablename__)
+        if entry is not None:
+            cafes[cafe_id] = entry.body
+    missing = [cafe_id for cafe_id in ids if cafe_id not in cafes]
+    if missing:
+        rows = session.execute(cafe_serializer.select().where(Cafe.id.in_(missing)))
+        for cafe in cafe_serializer.to_dicts(rows):
+            body = app.json.dumps(cafe).encode()
+            cafes[cafe["id"]] = response_cache.put(("cafe", cafe["id"]), Cafe.__tablename__, generation, body).body
+    return {cafe_id: cafes[cafe_id] for cafe_id in ids if cafe_id in cafes}
+
+def iter_cafes(after=0, fields=CAFE_FIELDS):
+    statement = cafe_serializer.select(fields).where(Cafe.id > after).order_by(Cafe.id)
+    result = session.execute(statement, execution_options={"yield_per": STREAM_BATCH_SIZE})
+    for rows in result.partitions():
+        yield from cafe_serializer.to_dicts(rows, fields)
+
+def stream_ndjson(after=0, fields=CAFE_FIELDS):
+    for cafe in iter_cafes(after, fields):
+        yield app.json.dumps(cafe) + "\n"
+
+def stream_json(after=0, fields=CAFE_FIELDS):
+    # same document as jsonify(cafes_list=[...]), sent one cafe at a time
+    yield '{"cafes_list": ['
+    separator = ""
+    for cafe in iter_cafes(after, fields):
+        yield separator + app.json.dumps(cafe)
+        separator = ", "
+    yield "]}\n"
+
 def to_dict(cafe:Cafe):
     return {
         "id":cafe.id,
@@ -168,5 +492,93 @@ def to_dict(cafe:Cafe):
     }
 
 
+# CLI commands
+# flask --app RESTful-API/cafe-api/main cafes import <file> / cafes export <file>
+# (a running server serves the new cafes right away)
+cafes_cli = AppGroup("cafes", help="Import and export the cafes.")
+IMPORT_FORMATS = bulk_io.FORMATS + ("coffee-and-wifi",)
+COMMIT_EVERY = 100_000  # rows per transaction
+EXPORT_FIELDS = CAFE_FIELDS + ("lat", "lng")
+MAX_REPORTED_ERRORS = 10
+
+@cafes_cli.command("import")
+@click.argument("path")
+@click.option("--format", "format", type=click.Choice(IMPORT_FORMATS),
+              help="csv, ndjson, or coffee-and-wifi for WTForms/coffee-and-wifi/cafe-data.csv (default: from the extension).")
+@click.option("--on-conflict", type=click.Choice(bulk.ON_CONFLICT), default="skip", show_default=True,
+              help="What to do with a cafe whose name is already stored.")
+@click.option("--commit-every", type=int, default=COMMIT_EVERY, show_default=True, help="Rows per transaction.")
+def import_cafes(path, format, on_conflict, commit_every):
+    """Load cafes from a CSV or NDJSON file ("-" reads stdin)."""
+    try:
+        file_format = "csv" if format == "coffee-and-wifi" else bulk_io.file_format(path, format)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    counts = bulk_io.import_counts()
+    progress = bulk_io.Progress("cafes import")
+
+    with bulk_io.open_file(path, "r") as file, engine.connect() as connection:
+        rows = bulk_io.read_rows(file, file_format)
+        if format == "coffee-and-wifi":
+            rows = map(bulk.coffee_and_wifi_cafe, rows)
+        uncommitted = 0
+        try:
+            for chunk in bulk_io.chunks(enumerate(rows, 1)):
+                cafes = []
+                for row_number, data in chunk:
+                    try:
+                        cafes.append(bulk.parse_cafe(data, bulk.IMPORT_OPTIONAL_FIELDS))
+                    except ValueError as error:
+                        counts["invalid"] += 1
+                        if counts["invalid"] <= MAX_REPORTED_ERRORS:
+                            click.echo(f"Row {row_number}: {error}", err=True)
+                if cafes:
+                    # one executemany per chunk, many chunks per transaction
+                    existing = bulk.existing_ids(connection, Cafe.__table__, [cafe["name"] for cafe in cafes])
+                    bulk.insert_chunk(connection, Cafe.__table__, cafes, on_conflict)
+                    for cafe in cafes:
+                        if cafe["name"] in existing:
+                            counts["updated" if on_conflict == "update" else "skipped"] += 1
+                        else:
+                            counts["created"] += 1
+                            existing[cafe["name"]] = None  # the same name again in this file is a conflict
+                uncommitted += len(chunk)
+                if uncommitted >= commit_every:
+                    connection.commit()
+                    uncommitted = 0
+                progress.add(len(chunk))
+            connection.commit()
+        except ValueError as error:  # a line that is not JSON
+            connection.rollback()
+            raise click.ClickException(f"{error} The rows after the last commit were not imported.")
+    progress.done(bulk_io.import_summary(counts))
+    return counts
+
+@cafes_cli.command("export")
+@click.argument("path")
+@click.option("--format", "format", type=click.Choice(bulk_io.FORMATS), help="Default: from the extension.")
+def export_cafes(path, format):
+    """Write all the cafes to a CSV or NDJSON file ("-" writes stdout)."""
+    try:
+        file_format = bulk_io.file_format(path, format)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    progress = bulk_io.Progress("cafes export")
+
+    with engine.connect() as connection, bulk_io.open_file(path, "w") as file:
+        statement = select(*(Cafe.__table__.c[field] for field in EXPORT_FIELDS)).order_by(Cafe.id)
+        result = connection.execution_options(yield_per=STREAM_BATCH_SIZE).execute(statement)
+
+        def rows():
+            for partition in result.partitions():
+                yield from partition
+                progress.add(len(partition))
+
+        bulk_io.write_rows(file, rows(), EXPORT_FIELDS, file_format)
+    progress.done()
+
+app.cli.add_command(cafes_cli)
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,140 @@
+import random
+import threading
+from array import array
+
+from sqlalchemy import func, select
+
+from shared.table_versions import table_version
+
+
+# Random row selection without loading the whole table.
+# Keeps every id of the table in a compact array ('q' = 8 bytes per id) plus a
+# position map, so picking a random row is O(1) and adding / removing an id is
+# O(1) (swap with the last element and pop).
+# Right after a restart the array is still empty - until it is warmed up we
+# fall back to probing a random point of the id range, which only needs the
+# primary key index.
+# Like SearchIndex it remembers the version of the table it was loaded from (see
+# shared/table_versions.py); a sample that sees a newer version - a write of
+# another process or of the CLI - reloads the ids in the background, and the
+# old ids are sampled until the new ones are ready.
+class RandomIndex:
+    def __init__(self, model):
+        self.model = model
+        self.ids = array('q')
+        self.positions = {}
+        self.engine = None
+        self.version = None
+        self.ready = False
+        self.loading = False
+        self.pending = []  # writes that happened while the index was loading
+        self.lock = threading.Lock()
+
+    # Loading the index
+    def load(self, engine, batch_size=10000):
+        with self.lock:
+            self.engine = engine
+            self.loading = True
+
+        ids = array('q')
+        with engine.connect() as connection:
+            # read before the rows: a write in between makes the index look older, never newer
+            version = table_version(connection, self.model.__tablename__)
+            result = connection.execution_options(yield_per=batch_size).execute(select(self.model.id))
+            for partition in result.partitions():
+                ids.extend(row[0] for row in partition)
+
+        with self.lock:
+            self.ids = ids
+            self.positions = {cafe_id: position for position, cafe_id in enumerate(ids)}
+            self.version = version
+            self.ready = True
+            self.loading = False
+            pending, self.pending = self.pending, []
+        # replay the writes that may be missing from the snapshot
+        for operation, cafe_id in pending:
+            operation(cafe_id)
+
+    def load_in_background(self, engine):
+        with self.lock:
+            if self.loading:
+                return None
+            self.loading = True
+        thread = threading.Thread(target=self.load, args=(engine,), daemon=True)
+        thread.start()
+        return thread
+
+    # Incremental maintenance (called by the write routes)
+    # version: the version of the table right after a write of one row, if known
+    def add(self, cafe_id, version=None):
+        with self.lock:
+            if self.loading:
+                self.pending.append((self.add, cafe_id))
+            if not self.ready:
+                return
+            if cafe_id not in self.positions:
+                self.positions[cafe_id] = len(self.ids)
+                self.ids.append(cafe_id)
+            self.move_to(version)
+
+    def remove(self, cafe_id, version=None):
+        with self.lock:
+            if self.loading:
+                self.pending.append((self.remove, cafe_id))
+            if not self.ready:
+                return
+            if cafe_id in self.positions:
+                position = self.positions.pop(cafe_id)
+                last_id = self.ids.pop()
+                if last_id != cafe_id:
+                    self.ids[position] = last_id
+                    self.positions[last_id] = position
+            self.move_to(version)
+
+    def move_to(self, version, changes=1):
+        if version is not None and self.ready and not self.loading and self.version == version - changes:
+            self.version = version
+
+    def synced(self, version, changes):
+        # the writes of this process that brought the table to version (changes rows,
+        # each applied with version=None) are in the index
+        with self.lock:
+            self.move_to(version, changes)
+
+    # Random selection
+    def sample_ids(self, n, version=None):
+        # n distinct random ids (fewer if the table is smaller), or None until the index is loaded.
+        # version: the current version of the table
+        with self.lock:
+            if not self.ready:
+                return None
+            stale = version is not None and version > self.version and not self.loading
+            ids = random.sample(self.ids, min(n, len(self.ids)))
+        if stale:
+            self.load_in_background(self.engine)
+        return ids
+
+    def probe(self, session, n, max_rounds=5):
+        # Gap tolerant: pick random points of [min id, max id] and take the first
+        # existing id at or after each point (wrapping around to the start).
+        low, high = session.query(func.min(self.model.id), func.max(self.model.id)).one()
+        if low is None:
+            return []
+
+        found = {}
+        for _ in range(max_rounds):
+            missing = n - len(found)
+            if missing <= 0:
+                break
+            for point in random.sample(range(low, high + 1), min(missing, high - low + 1)):
+                row = (session.query(self.model)
+                       .filter(self.model.id >= point, self.model.id.notin_(found))
+                       .order_by(self.model.id).first())
+                if row is None:
+                    row = (session.query(self.model)
+                           .filter(self.model.id.notin_(found))
+                           .order_by(self.model.id).first())
+                if row is None:  # every row is already in the sample
+                    return list(found.values())
+                found[row.id] = row
+        return list(found.values())
@@ -0,0 +1,118 @@
+import functools
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from urllib.parse import urlencode
+
+from flask import Response, g, has_request_context, make_response, request
+
+
+CachedResponse = namedtuple("CachedResponse", ["table", "generation", "body", "etag", "mimetype"])
+
+
+# Cache of serialized responses, invalidated by writes.
+# The generation of a table is its version in the database (see
+# shared/table_versions.py), which every write bumps - in this process or any
+# other. An entry remembers the generation it was built from and is only served
+# while that is still the current generation, so a response computed while a
+# write was committing is never served after it.
+# The generation is read once per request (one primary key lookup), in the
+# request's transaction, so it matches the rows the view reads.
+# The cache is an LRU bounded by the total size of the cached bodies.
+class ResponseCache:
+    def __init__(self, version, max_bytes=32 * 1024 * 1024, max_entry_bytes=4 * 1024 * 1024):
+        self.version = version  # table name -> its current version in the database
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    # Generations
+    def generation(self, table):
+        if not has_request_context():
+            return self.version(table)
+        generations = g.setdefault("response_cache_generations", {})
+        if table not in generations:
+            generations[table] = self.version(table)
+        return generations[table]
+
+    def invalidate(self, table):
+        # frees the entries of a table right after a write of this process - they
+        # would not be served anyway, since the write bumped the version
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry.table == table]:
+                self.drop(key)
+
+    # Entries
+    def get(self, key, table):
+        generation = self.generation(table)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.generation != generation:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, table, generation, body, mimetype="application/json"):
+        entry = CachedResponse(table, generation, body, hashlib.sha1(body).hexdigest(), mimetype)
+        if len(body) > self.max_entry_bytes:
+            return entry
+        with self.lock:
+            current = self.entries.get(key)
+            if current is not None and current.generation > generation:  # built after a newer write
+                return entry
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = entry
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+                self.evictions += 1
+        return entry
+
+    def drop(self, key):
+        entry = self.entries.pop(key)
+        self.size -= len(entry.body)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
+
+    # Flask helpers
+    def cached(self, table):
+        # decorator for a GET view that reads <table>: successful, non streamed
+        # responses are cached by path and query string.
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                key = request.path + "?" + urlencode(sorted(request.args.items(multi=True)))
+                entry = self.get(key, table)
+                if entry is None:
+                    generation = self.generation(table)
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    entry = self.put(key, table, generation, response.get_data(), response.mimetype)
+                return self.respond(entry)
+            return wrapper
+        return decorator
+
+    def respond(self, entry):
+        if request.if_none_match.contains(entry.etag):
+            response = Response(status=304)
+        else:
+            response = Response(entry.body, mimetype=entry.mimetype)
+        response.set_etag(entry.etag)
+        return response
@@ -0,0 +1,237 @@
+import re
+import string
+import threading
+
+from sqlalchemy import select
+
+from shared.table_versions import table_version
+
+
+NONZERO_BYTE = re.compile(b'[^\x00]', re.DOTALL)
+IN_CHUNK_SIZE = 500
+# SQLite's NOCASE collation only folds the ASCII letters
+NOCASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def normalize_area(area):
+    # the searched area: surrounding and repeated whitespace removed
+    return " ".join(area.split())
+
+
+def location_key(location):
+    # a location as the NOCASE index of the database compares it, so the index
+    # and search_database() match the same cafes
+    return location.translate(NOCASE)
+
+
+# Set of ids stored as a bit array - bit number <id> is set when the id is in the set.
+# Updates only touch one byte, queries turn the bytes into an int so that
+# intersections are done by Python's big int '&'.
+class Bitset:
+    def __init__(self):
+        self.bits = bytearray()
+
+    def add(self, number):
+        byte_index = number >> 3
+        if byte_index >= len(self.bits):
+            self.bits.extend(bytes(byte_index - len(self.bits) + 1))
+        self.bits[byte_index] |= 1 << (number & 7)
+
+    def discard(self, number):
+        byte_index = number >> 3
+        if byte_index < len(self.bits):
+            self.bits[byte_index] &= ~(1 << (number & 7)) & 0xFF
+
+    def to_int(self):
+        return int.from_bytes(self.bits, 'little')
+
+
+def iter_bits(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'little')
+    # the regex skips the empty bytes in C, so sparse results are cheap
+    for match in NONZERO_BYTE.finditer(data):
+        byte_index = match.start()
+        byte = data[byte_index]
+        for bit in range(8):
+            if byte >> bit & 1:
+                yield byte_index * 8 + bit
+
+
+# In-memory index for searching cafes by area and amenities.
+# One bitset per boolean amenity and one per (normalized) location, so a query
+# like "wifi and sockets in Peckham" is a few bitset intersections and only the
+# matching rows are read from the database.
+# Until the index is loaded (right after a restart) searches go to the database,
+# which has an index on the location column.
+# The index remembers the version of the table it was built from (see
+# shared/table_versions.py). When a search sees a newer version - a write of
+# another process or of the CLI - it goes to the database and the index is
+# rebuilt in the background. The writes of this process are applied to the
+# index and move its version forward.
+class SearchIndex:
+    def __init__(self, model, amenities, location_column='location'):
+        self.model = model
+        self.amenities = amenities  # filter name -> boolean column name
+        self.location_column = location_column
+        self.engine = None
+        self.version = None
+        self.ready = False
+        self.loading = False
+        self.pending = []  # writes that happened while the index was loading
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.all_ids = Bitset()
+        self.amenity_ids = {name: Bitset() for name in self.amenities}
+        self.location_ids = {}
+        self.location_of = {}  # id -> location key, to find the old bitset on update / delete
+
+    def record(self, row):
+        # plain values - ORM objects expire on commit and may be detached later
+        return (
+            row.id,
+            location_key(getattr(row, self.location_column)),
+            {name: bool(getattr(row, column)) for name, column in self.amenities.items()},
+        )
+
+    def row_record(self, row):
+        # the same values from a (id, location, *amenities) result row
+        row_id, location, *flags = row
+        return row_id, location_key(location), {name: bool(flag) for name, flag in zip(self.amenities, flags)}
+
+    # Loading the index
+    def load(self, engine, batch_size=10000):
+        with self.lock:
+            self.engine = engine
+            self.ready = False
+            self.loading = True
+            self.clear()
+
+        columns = [self.model.id, getattr(self.model, self.location_column)]
+        columns += [getattr(self.model, column) for column in self.amenities.values()]
+        with engine.connect() as connection:
+            # read before the rows: a write in between makes the index look older, never newer
+            version = table_version(connection, self.model.__tablename__)
+            result = connection.execution_options(yield_per=batch_size).execute(select(*columns))
+            for partition in result.partitions():
+                with self.lock:
+                    for row in partition:
+                        self.insert(self.row_record(row))
+
+        with self.lock:
+            self.version = version
+            self.ready = True
+            self.loading = False
+            pending, self.pending = self.pending, []
+        # replay the writes that may be missing from the snapshot
+        for operation, record in pending:
+            with self.lock:
+                operation(record)
+
+    def load_in_background(self, engine):
+        with self.lock:
+            if self.loading:
+                return None
+            self.loading = True
+        thread = threading.Thread(target=self.load, args=(engine,), daemon=True)
+        thread.start()
+        return thread
+
+    # Incremental maintenance (called by the write routes)
+    # version: the version of the table right after a write of one row, if known
+    def add(self, row, version=None):
+        self.apply(self.insert, self.record(row), version)
+
+    def update(self, row, version=None):
+        self.apply(self.replace, self.record(row), version)
+
+    def remove(self, row_id, version=None):
+        self.apply(self.delete, row_id, version)
+
+    def apply(self, operation, argument, version=None):
+        with self.lock:
+            if self.loading:
+                self.pending.append((operation, argument))
+            elif self.ready:
+                operation(argument)
+                self.move_to(version)
+
+    def synced(self, version, changes):
+        # the writes of this process that brought the table to version (changes rows,
+        # each applied with version=None) are in the index
+        with self.lock:
+            self.move_to(version, changes)
+
+    def move_to(self, version, changes=1):
+        if version is not None and self.ready and not self.loading and self.version == version - changes:
+            self.version = version
+
+    def insert(self, record):
+        row_id, location, flags = record
+        self.all_ids.add(row_id)
+        for name, flag in flags.items():
+            if flag:
+                self.amenity_ids[name].add(row_id)
+        self.location_ids.setdefault(location, Bitset()).add(row_id)
+        self.location_of[row_id] = location
+
+    def delete(self, row_id):
+        self.all_ids.discard(row_id)
+        for bitset in self.amenity_ids.values():
+            bitset.discard(row_id)
+        location = self.location_of.pop(row_id, None)
+        if location is not None:
+            self.location_ids[location].discard(row_id)
+
+    def replace(self, record):
+        self.delete(record[0])
+        self.insert(record)
+
+    # Searching
+    def search(self, session, statement, area=None, filters=None, version=None):
+        # statement: the SELECT of the columns to return, filtered here.
+        # filters: filter name -> True (must have) / False (must not have)
+        # version: the current version of the table
+        filters = filters or {}
+        with self.lock:
+            stale = self.ready and version is not None and version != self.version
+            if self.ready and not stale:
+                matches = self.match(area, filters)
+            else:
+                matches = None
+
+        if stale:
+            self.load_in_background(self.engine)
+        if matches is None:
+            return self.search_database(session, statement, area, filters)
+
+        ids = list(iter_bits(matches))
+        rows = []
+        for start in range(0, len(ids), IN_CHUNK_SIZE):
+            chunk = ids[start:start + IN_CHUNK_SIZE]
+            rows += session.execute(statement.where(self.model.id.in_(chunk)).order_by(self.model.id)).all()
+        return rows
+
+    def match(self, area, filters):
+        matches = self.all_ids.to_int()
+        if area is not None:
+            location_bitset = self.location_ids.get(location_key(normalize_area(area)))
+            if location_bitset is None:
+                return 0
+            matches &= location_bitset.to_int()
+        for name, wanted in filters.items():
+            if wanted:
+                matches &= self.amenity_ids[name].to_int()
+            else:
+                matches &= ~self.amenity_ids[name].to_int()
+        return matches
+
+    def search_database(self, session, statement, area, filters):
+        if area is not None:
+            # uses the NOCASE index on the location column
+            location = getattr(self.model, self.location_column).collate('NOCASE')
+            statement = statement.where(location == normalize_area(area))
+        for name, wanted in filters.items():
+            statement = statement.where(getattr(self.model, self.amenities[name]) == wanted)
+        return session.execute(statement.order_by(self.model.id)).all()
@@ -0,0 +1,39 @@
+from sqlalchemy import select
+
+
+MAX_CACHED_STATEMENTS = 128  # sets of ?fields= are chosen by the clients
+
+
+# Fast path for turning cafes into JSON-ready dicts.
+# Instead of loading ORM objects (identity map, change tracking, attribute
+# instrumentation) and reading them one attribute at a time, the list routes
+# select only the columns they send and zip each result tuple with the field names.
+class RowSerializer:
+    def __init__(self, table, fields):
+        self.table = table
+        self.fields = tuple(fields)
+        self.statements = {}  # fields -> SELECT
+
+    def parse_fields(self, value):
+        # ?fields=id,name,location -> ("id", "name", "location"); raises ValueError for unknown fields
+        if not value:
+            return self.fields
+        fields = tuple(dict.fromkeys(field.strip() for field in value.split(",") if field.strip()))
+        unknown = [field for field in fields if field not in self.fields]
+        if unknown or not fields:
+            raise ValueError("fields must be a comma separated list of: " + ", ".join(self.fields) + ".")
+        return fields
+
+    def select(self, fields=None):
+        # the SELECT of these columns, built once per set of fields
+        fields = fields or self.fields
+        statement = self.statements.get(fields)
+        if statement is None:
+            statement = select(*[self.table.c[field] for field in fields])
+            if len(self.statements) < MAX_CACHED_STATEMENTS:
+                self.statements[fields] = statement
+        return statement
+
+    def to_dicts(self, rows, fields=None):
+        fields = fields or self.fields
+        return [dict(zip(fields, row)) for row in rows]
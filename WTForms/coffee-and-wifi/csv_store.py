@@ -0,0 +1,89 @@
+import csv
+import io
+import os
+import threading
+
+
+# In-memory copy of a CSV file that is only ever appended to.
+# os.stat() tells whether the file changed since the last read (size / mtime);
+# when it grew, only the new bytes are parsed. A file that shrank or was
+# replaced is read again from the start.
+# The last line may not end with a newline yet (rows are also written as
+# "\n<row>"), so it is kept apart and parsed again on the next refresh.
+class CsvStore:
+    def __init__(self, path, encoding="utf8"):
+        self.path = path
+        self.encoding = encoding
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.header = []
+        self.rows = []  # complete lines, without the header
+        self.last_row = None  # the unterminated last line
+        self.offset = 0  # bytes of the file already in self.rows
+        self.signature = None  # (inode, size, mtime) of the file at the last read
+
+    def refresh(self):
+        stat = os.stat(self.path)
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if signature == self.signature:
+                return
+            if self.signature is None or stat.st_ino != self.signature[0] or stat.st_size < self.offset:
+                self.reset()
+            self.read_new_bytes()
+            self.signature = signature
+
+    def read_new_bytes(self):
+        with open(self.path, "rb") as file:
+            file.seek(self.offset)
+            data = file.read()
+
+        if self.offset == 0:  # the header may have been taken from the unterminated line
+            self.header = []
+        end = data.rfind(b"\n") + 1
+        complete, rest = data[:end], data[end:]
+        self.append_rows(self.parse(complete))
+        self.offset += end
+        last_rows = self.parse(rest)
+        self.last_row = last_rows[0] if last_rows else None
+        if self.last_row is not None and not self.header:  # a file with a single line
+            self.header, self.last_row = self.last_row, None
+
+    def parse(self, data):
+        text = data.decode(self.encoding)
+        return [row for row in csv.reader(io.StringIO(text, newline=""), delimiter=",") if row]
+
+    def append_rows(self, rows):
+        if rows and not self.header:
+            self.header, rows = rows[0], rows[1:]
+        self.rows.extend(rows)
+
+    def appended(self, rows, start, stat):
+        # called by the writer of the file after it appended <rows> at byte <start>:
+        # when the store was up to date, take the rows without reading the file again.
+        with self.lock:
+            if self.signature is None or self.signature[:2] != (stat.st_ino, start):
+                return  # the file changed in the meantime - refresh() will read it
+            if self.last_row is not None:  # the writer ended it with a newline
+                self.rows.append(self.last_row)
+                self.last_row = None
+            self.append_rows([list(row) for row in rows])
+            self.offset = stat.st_size
+            self.signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    # Reading
+    def count(self):
+        self.refresh()
+        return len(self.rows) + (self.last_row is not None)
+
+    def page(self, number, size):
+        # rows of page <number> (starting at 1), without the header
+        self.refresh()
+        with self.lock:
+            start = (number - 1) * size
+            rows = self.rows[start:start + size]
+            if self.last_row is not None and len(rows) < size and start + len(rows) == len(self.rows):
+                rows = rows + [self.last_row]
+            return rows
@@ -0,0 +1,108 @@
+import atexit
+import csv
+import io
+import os
+import threading
+
+try:
+    import fcntl  # not available on Windows - the file is then not locked
+except ImportError:
+    fcntl = None
+
+
+class Batch:
+    def __init__(self):
+        self.rows = []
+        self.done = threading.Event()
+        self.error = None
+
+
+# Appends rows to a CSV file, safely between threads and processes.
+# Rows are quoted by csv.writer and written under an exclusive flock, then
+# fsync'ed. With group_commit, rows that arrive together are buffered and
+# written with one write + fsync - every max_rows rows or interval_ms after the
+# first buffered row - and append() returns once its batch is on disk.
+# The CsvStore of the same file (if given) gets the new rows right away.
+class CsvAppender:
+    def __init__(self, path, store=None, group_commit=False, max_rows=100, interval_ms=50, encoding="utf8"):
+        self.path = path
+        self.store = store
+        self.encoding = encoding
+        self.group_commit = group_commit
+        self.max_rows = max_rows
+        self.interval = interval_ms / 1000
+        self.closed = False
+
+        if group_commit:
+            self.condition = threading.Condition()
+            self.batch = Batch()
+            self.flusher = threading.Thread(target=self.run, daemon=True)
+            self.flusher.start()
+            atexit.register(self.close)
+
+    def append(self, row):
+        if not self.group_commit:
+            self.write_rows([row])
+            return
+
+        with self.condition:
+            if self.closed:
+                raise ValueError("The CSV appender is closed.")
+            batch = self.batch
+            batch.rows.append(row)
+            self.condition.notify_all()
+        batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+
+    def close(self):
+        if self.group_commit and not self.closed:
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+            self.flusher.join()
+        self.closed = True
+
+    # Group commit
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.batch.rows or self.closed)
+                # give the rest of a burst interval_ms to join the batch
+                self.condition.wait_for(lambda: len(self.batch.rows) >= self.max_rows or self.closed,
+                                        timeout=self.interval)
+                batch, self.batch = self.batch, Batch()
+                if not batch.rows and self.closed:
+                    return
+
+            try:
+                self.write_rows(batch.rows)
+            except Exception as error:  # handed to the waiting append() calls
+                batch.error = error
+            batch.done.set()
+
+    # Writing
+    def write_rows(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        data = buffer.getvalue().encode(self.encoding)
+
+        with open(self.path, "a+b") as file:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                start = file.seek(0, os.SEEK_END)
+                # older rows were written as "\n<row>", so the file may not end with a newline
+                if start > 0:
+                    file.seek(start - 1)
+                    if file.read(1) != b"\n":
+                        data = b"\n" + data
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+                stat = os.fstat(file.fileno())
+                if self.store is not None:
+                    self.store.appended(rows, start, stat)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_UN)
@@ -1,13 +1,29 @@
-from flask import Flask, render_template
+from flask import Flask, render_template, request
 from flask_bootstrap import Bootstrap
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, SelectField, URLField
 from wtforms.validators import DataRequired, URL
-import csv
+import math
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))  # repository root, for the shared modules
+from shared.instrumentation import init_instrumentation
+
+from csv_store import CsvStore
+from csv_writer import CsvAppender
+
+CAFES_PER_PAGE = 50
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = '8BYkEfBA6O6donzWlSihBXox7C0sKR6b'
 Bootstrap(app)
+init_instrumentation(app)  # request timing and /metrics
+
+# the cafes of the CSV file, kept in memory and re-read only when the file grows.
+cafe_store = CsvStore('coffee-and-wifi/cafe-data.csv')
+# new cafes are written in small batches (group commit) and added to cafe_store right away.
+cafe_writer = CsvAppender('coffee-and-wifi/cafe-data.csv', store=cafe_store, group_commit=True)
 
 
 class CafeForm(FlaskForm):
@@ -30,18 +46,18 @@ def home():
 def add_cafe():
     form = CafeForm()
     if form.validate_on_submit():
-        with open('coffee-and-wifi/cafe-data.csv', 'a', encoding="utf8") as csv_file:
-            csv_file.write(f"\n{form.cafe.data},{form.location.data},{form.open_time.data},{form.closing_time.data},{form.coffee_rating.data},{form.wifi_rating.data},{form.power_socket_rating.data}")
+        cafe_writer.append([form.cafe.data, form.location.data, form.open_time.data, form.closing_time.data,
+                            form.coffee_rating.data, form.wifi_rating.data, form.power_socket_rating.data])
     return render_template('add.html', form=form)
 
 @app.route('/cafes')
 def cafes():
-    with open('coffee-and-wifi/cafe-data.csv', newline='', encoding="utf8") as csv_file:
-        csv_data = csv.reader(csv_file, delimiter=',')
-        list_of_rows = []
-        for row in csv_data:
-            list_of_rows.append(row)
-    return render_template('cafes.html', cafes=list_of_rows, num_of_rows=len(list_of_rows))
+    # http://127.0.0.1:5000/cafes?page=<page number>
+    num_of_pages = max(1, math.ceil(cafe_store.count() / CAFES_PER_PAGE))
+    page = min(max(request.args.get('page', 1, type=int), 1), num_of_pages)
+    list_of_rows = cafe_store.page(page, CAFES_PER_PAGE)
+    return render_template('cafes.html', header=cafe_store.header, cafes=list_of_rows, num_of_rows=len(list_of_rows),
+                           page=page, num_of_pages=num_of_pages)
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,71 @@
+import mimetypes
+import os
+import threading
+from urllib.parse import quote
+
+from flask import abort, request, send_file
+from werkzeug.http import parse_range_header
+from werkzeug.security import safe_join
+
+
+# Sends the files of a folder to logged in users.
+# send_file() answers Range / If-Range requests with 206 partial content (resumable
+# and parallel downloads) and If-None-Match / If-Modified-Since with 304, and
+# reads the file in chunks - through the server's wsgi.file_wrapper, which uses
+# sendfile() when the server supports it - so a big file is never held in memory.
+# The web server can also send the file itself:
+#   USE_X_SENDFILE = True                  -> X-Sendfile header (Apache, lighttpd)
+#   DOWNLOADS_ACCEL_PREFIX = "/protected/" -> X-Accel-Redirect header (nginx internal location)
+# The bytes sent for every file are counted in stats().
+class Downloads:
+    def __init__(self, app, folder, max_age=3600):
+        self.app = app
+        self.folder = os.path.join(app.root_path, folder)
+        self.max_age = max_age
+        self.counters = {}  # file name -> {"requests": ..., "bytes": ...}
+        self.lock = threading.Lock()
+
+    def send(self, filename):
+        path = safe_join(self.folder, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+
+        accel_prefix = self.app.config.get("DOWNLOADS_ACCEL_PREFIX")
+        if accel_prefix:
+            # an empty response - nginx reads the file and answers the Range headers itself
+            response = self.app.response_class(mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream")
+            # nginx decodes the URI of the redirect, so spaces, "%" and non-ASCII names are percent-encoded
+            response.headers["X-Accel-Redirect"] = accel_prefix.rstrip("/") + "/" + quote(filename)
+            sent_bytes = 0 if request.method == "HEAD" else self.requested_bytes(os.path.getsize(path))
+        else:
+            response = send_file(path, conditional=True, etag=True, max_age=self.max_age)
+            sent_bytes = 0 if request.method == "HEAD" or response.status_code == 304 else response.content_length or 0
+        # behind a login - browsers may cache the file, shared caches may not
+        response.cache_control.public = False
+        response.cache_control.private = True
+        self.count(filename, sent_bytes)
+        return response
+
+    def requested_bytes(self, size):
+        # the length of the requested ranges (nginx answers a Range request with
+        # 206 and only those parts, or 416 if none is in the file), or the whole file
+        file_range = parse_range_header(request.headers.get("Range"))
+        if file_range is None:
+            return size
+        requested = 0
+        for start, stop in file_range.ranges:
+            if start < 0:  # "bytes=-500" - the last 500 bytes
+                start, stop = max(size + start, 0), size
+            stop = size if stop is None else min(stop, size)
+            requested += max(stop - start, 0)
+        return requested
+
+    def count(self, filename, sent_bytes):
+        with self.lock:
+            counter = self.counters.setdefault(filename, {"requests": 0, "bytes": 0})
+            counter["requests"] += 1
+            counter["bytes"] += sent_bytes
+
+    def stats(self):
+        with self.lock:
+            return {filename: dict(counter) for filename, counter in self.counters.items()}
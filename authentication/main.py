@@ -1,24 +1,49 @@
-from flask import Flask, render_template, request, url_for, redirect, flash, send_from_directory
+from flask import Flask, render_template, request, url_for, redirect, flash, jsonify
 from flask_bootstrap import Bootstrap
 from flask_login import UserMixin, login_user, LoginManager, login_required, current_user, logout_user
-from werkzeug.security import generate_password_hash, check_password_hash
 
 import sqlalchemy
-from sqlalchemy import create_engine, Column, Integer, String
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, String
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # repository root, for the shared modules
+from shared.database import create_sqlite_engine, init_session
+from shared.instrumentation import init_instrumentation
+
+from downloads import Downloads
+from user_cache import UserCache, CachedUser
+from password_hasher import PasswordHasher, HasherBusy
+
+
+# the password hashes, as register() always made them: werkzeug's pbkdf2:sha256 with
+# its default number of iterations. Hashes of another method or salt length are
+# hashed again on login.
+PASSWORD_HASH_METHOD = "pbkdf2:sha256"
+PASSWORD_SALT_LENGTH = 8
+PASSWORD_HASH_TIMEOUT = 5  # seconds
 
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'any-secret-key'
+# let the web server send the files (see downloads.py)
+app.config['USE_X_SENDFILE'] = False
+app.config['DOWNLOADS_ACCEL_PREFIX'] = None
 Bootstrap(app)
 
 # Configure login manager that handles the common tasks of logging in, logging out, and remembering your users sessions over extended periods of time.
 login_manager = LoginManager()
 login_manager.init_app(app)
 
+# files for logged in users
+downloads = Downloads(app, "static/files")
+
+# hashes the passwords in worker processes (see password_hasher.py)
+hasher = PasswordHasher(PASSWORD_HASH_METHOD, PASSWORD_SALT_LENGTH, timeout=PASSWORD_HASH_TIMEOUT)
+
 # Create DataBase
-engine = create_engine('sqlite:///authentication/users.db')
+engine = create_sqlite_engine('sqlite:///authentication/users.db')
 Base = sqlalchemy.orm.declarative_base()
 
 # NOTE: We can see the DB in the DB Browser of "SQLite" that installed on our computer:
@@ -29,17 +54,28 @@ class User(UserMixin, Base):
     __tablename__ = 'user'
     id = Column(Integer, primary_key=True)
     email = Column(String(100), unique=True)
-    password = Column(String(100))
+    password = Column(String(200))
     name = Column(String(1000))
 
 Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-session = Session()
+session = init_session(app, engine)
+init_instrumentation(app, engine)  # request timing, SQL statement counts and /metrics
+
+
+# the logged in users, so that current_user doesn't cost a query per request
+user_cache = UserCache()
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return session.query(User).get(user_id)
+    return user_cache.get(int(user_id), load_user_from_db)
+
+
+def load_user_from_db(user_id):
+    user = session.get(User, user_id)
+    if user is None:
+        return None
+    return CachedUser(user.id, user.email, user.name)
 
 
 # All app routes below
@@ -61,13 +97,11 @@ def register():
             new_user = User(
                 name = name,
                 email = email,
-                password = generate_password_hash(password=password, 
-                                                method="pbkdf2:sha256", 
-                                                salt_length=8
-                )
+                password = hasher.hash(password)
             )
             session.add(new_user)
             session.commit()
+            user_cache.invalidate(new_user.id)
             # log in that new user
             login_user(new_user)
             return redirect(url_for('secrets', name=name))
@@ -89,7 +123,9 @@ def login():
         user = session.query(User).filter_by(email=entered_email).first()
         if user is None: # that email does not exist in the database
             flash("Email does not exist. Try again.", "error")
-        elif check_password_hash(pwhash=user.password, password=entered_password):
+        elif hasher.check(user.password, entered_password):
+            if hasher.needs_rehash(user.password):
+                rehash_password(user, entered_password)
             login_user(user)
             return redirect(url_for('secrets'))
         else:
@@ -99,6 +135,24 @@ def login():
     return render_template("login.html")
 
 
+def rehash_password(user, password):
+    # the password is known only now, so this is where an old hash gets the current cost
+    try:
+        user.password = hasher.hash(password)
+    except HasherBusy:
+        return  # next time
+    session.commit()
+    user_cache.invalidate(user.id)
+
+
+@app.errorhandler(HasherBusy)
+def hasher_busy(error):
+    # too many logins at once - ask the client to come back instead of queueing more work
+    flash("The server is busy. Try again in a moment.", "error")
+    template = "register.html" if request.endpoint == "register" else "login.html"
+    return render_template(template, logged_in=current_user.is_authenticated), 503, {"Retry-After": "1"}
+
+
 @app.route('/secrets')
 @login_required
 def secrets():
@@ -107,14 +161,29 @@ def secrets():
 
 @app.route('/logout')
 def logout():
+    if current_user.is_authenticated:
+        user_cache.invalidate(int(current_user.get_id()))
     logout_user()
     return redirect(url_for('home'))
 
 
 @app.route('/download')
+@app.route('/download/<path:filename>')
+@login_required
+def download(filename="cheat_sheet.pdf"):
+    return downloads.send(filename)
+
+
+@app.route('/download-stats')
+@login_required
+def download_stats():
+    return jsonify(downloads.stats())
+
+
+@app.route('/user-cache-stats')
 @login_required
-def download():
-    return send_from_directory("static/files", path="cheat_sheet.pdf")
+def user_cache_stats():
+    return jsonify(user_cache.stats())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+# Raised when the password can't be hashed in time - too many logins waiting,
+# or the hash took longer than the timeout. The app answers it with a 503.
+class HasherBusy(Exception):
+    pass
+
+
+# Hashes and checks passwords in a pool of worker processes, so that a burst of
+# logins keeps the CPU of the pool busy instead of every web worker - the
+# requests that don't hash a password are still answered.
+# At most `workers + queue_size` hashes are running or waiting; past that (or
+# after `timeout` seconds) the call raises HasherBusy instead of queueing more.
+# With use_pool=False the hashing runs on the request thread, as before.
+# The pool is created with the app, and its workers are started by a forkserver
+# (spawn where there is none): forking the threaded web server could copy a lock
+# held by another thread into a worker and deadlock it.
+class PasswordHasher:
+    def __init__(self, method, salt_length, workers=None, queue_size=None, timeout=5.0, use_pool=True):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.use_pool = use_pool
+        self.slots = threading.BoundedSemaphore(self.workers + (self.workers * 4 if queue_size is None else queue_size))
+        self.executor = self.new_pool() if use_pool else None  # the processes start on the first hash
+        self.lock = threading.Lock()
+        self.rejected = 0
+        self.timed_out = 0
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method, self.salt_length)
+
+    def check(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        # hashes made with another method or salt length are hashed again on the next login.
+        # werkzeug writes the iterations into the hash ("pbkdf2:sha256:<iterations>"), so
+        # they only count when self.method sets them.
+        method, _, rest = pwhash.partition("$")
+        salt = rest.partition("$")[0]
+        wanted = self.method.split(":")
+        return method.split(":")[:len(wanted)] != wanted or len(salt) != self.salt_length
+
+    def run(self, function, *args):
+        if not self.use_pool:
+            return function(*args)
+
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise HasherBusy("Too many passwords are being hashed.")
+        try:
+            future = self.pool().submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        # the slot is free once the worker is done, even when the request stopped waiting
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            with self.lock:
+                self.timed_out += 1
+            raise HasherBusy("Hashing the password took too long.")
+
+    def pool(self):
+        with self.lock:
+            if self.executor is None:  # after shutdown()
+                self.executor = self.new_pool()
+            return self.executor
+
+    def new_pool(self):
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(start_method))
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers if self.use_pool else 0,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+            }
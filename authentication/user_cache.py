@@ -0,0 +1,64 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask_login import UserMixin
+
+
+# What the pages need to know about the logged in user - a plain object, not
+# bound to a database session, so it can be kept between requests.
+class CachedUser(UserMixin):
+    def __init__(self, id, email, name):
+        self.id = id
+        self.email = email
+        self.name = name
+
+
+# LRU cache of the logged in users, so that loading current_user doesn't query
+# the database on every request. Entries expire after ttl seconds, and the
+# routes that change a user (or log it out) drop its entry.
+class UserCache:
+    def __init__(self, max_users=1024, ttl=300):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.users = OrderedDict()  # user id -> (expiry time, CachedUser)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, user_id, load):
+        # load(user_id) returns the CachedUser from the database, or None
+        now = time.monotonic()
+        with self.lock:
+            entry = self.users.get(user_id)
+            if entry is not None and entry[0] > now:
+                self.users.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        user = load(user_id)
+        if user is not None:
+            with self.lock:
+                self.users[user_id] = (now + self.ttl, user)
+                self.users.move_to_end(user_id)
+                while len(self.users) > self.max_users:
+                    self.users.popitem(last=False)
+                    self.evictions += 1
+        return user
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.users.pop(user_id, None)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "users": len(self.users),
+                "hit_rate": round(self.hits / requests, 3) if requests else None,
+            }
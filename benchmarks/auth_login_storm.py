@@ -0,0 +1,98 @@
+# Measures the latency of the authentication home page (/) while many clients
+# log in at the same time: password hashing on the request threads against
+# hashing in the PasswordHasher process pool.
+#
+# Run from the repository root:
+#   python benchmarks/auth_login_storm.py [login clients] [seconds]
+# The app runs on a temporary database, users.db is not touched.
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+AUTHENTICATION = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "authentication")
+LOGIN_CLIENTS = 16
+SECONDS = 10
+PROBE_INTERVAL = 0.02
+EMAIL, PASSWORD = "storm@example.com", "correct horse battery staple"
+
+
+def load_app(directory):
+    # the app opens 'authentication/users.db' relative to the working directory
+    os.makedirs(os.path.join(directory, "authentication"))
+    os.chdir(directory)
+    sys.path.insert(0, AUTHENTICATION)
+    import main
+    return main
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float("nan")
+
+
+def storm(url, clients, seconds):
+    stop = threading.Event()
+    probes, logins = [], {"ok": 0, "busy": 0}
+    lock = threading.Lock()
+
+    def log_in():
+        with requests.Session() as http:
+            while not stop.is_set():
+                status = http.post(url + "/login", data={"email": EMAIL, "password": PASSWORD}, allow_redirects=False).status_code
+                with lock:
+                    logins["ok" if status == 302 else "busy"] += 1
+
+    def probe():
+        with requests.Session() as http:
+            while not stop.is_set():
+                start = time.perf_counter()
+                http.get(url + "/")
+                probes.append(time.perf_counter() - start)
+                time.sleep(PROBE_INTERVAL)
+
+    threads = [threading.Thread(target=log_in) for _ in range(clients)] + [threading.Thread(target=probe)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return probes, logins
+
+
+def run(clients, seconds):
+    with tempfile.TemporaryDirectory() as directory:
+        main = load_app(directory)
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)  # no line per request
+        server = make_server("127.0.0.1", 0, main.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}"
+
+        with main.app.app_context():
+            main.session.add(main.User(name="Storm", email=EMAIL, password=main.hasher.hash(PASSWORD)))
+            main.session.commit()
+        main.hasher.shutdown()
+
+        print(f"{clients} clients logging in for {seconds} s, {os.cpu_count()} CPUs")
+        print(f"{'hashing':>16} {'/ p50 ms':>9} {'/ p99 ms':>9} {'logins':>7} {'503':>5}")
+        for name, use_pool in (("request thread", False), ("process pool", True)):
+            main.hasher = main.PasswordHasher(main.PASSWORD_HASH_METHOD, main.PASSWORD_SALT_LENGTH,
+                                              timeout=main.PASSWORD_HASH_TIMEOUT, use_pool=use_pool)
+            probes, logins = storm(url, clients, seconds)
+            main.hasher.shutdown()
+            print(f"{name:>16} {statistics.median(probes) * 1000:>9.1f} {percentile(probes, 0.99) * 1000:>9.1f} "
+                  f"{logins['ok']:>7} {logins['busy']:>5}")
+
+        server.shutdown()
+        main.engine.dispose()
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else LOGIN_CLIENTS, int(sys.argv[2]) if len(sys.argv) > 2 else SECONDS)
@@ -0,0 +1,86 @@
+# Measures the my-blog home page on a large, seeded posts.db: the old listing
+# (every post, body included) against the paginated listing of home().
+#
+# Run from the repository root:
+#   python benchmarks/blog_home.py [posts] [body size in KB]
+# The blog runs on a temporary database, posts.db is not touched.
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+MY_BLOG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "my-blog")
+POSTS = 20_000
+BODY_KB = 8
+REPEAT = 5
+
+
+def load_app(directory):
+    # the blog opens 'RESTful-API/my-blog/posts.db' relative to the working directory
+    os.makedirs(os.path.join(directory, "RESTful-API", "my-blog"))
+    os.chdir(directory)
+    sys.path.insert(0, MY_BLOG)
+    import main
+    return main
+
+
+def seed(main, posts, body_kb):
+    paragraph = "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 16 + "</p>"
+    body = paragraph * (body_kb * 1024 // len(paragraph) + 1)
+    with main.engine.begin() as connection:
+        connection.execute(main.BlogPost.__table__.insert(), [
+            {
+                "title": f"Post number {i}",
+                "subtitle": f"The subtitle of post {i}",
+                "date": "January 01, 2024",
+                "body": body,
+                "author": "Liel",
+                "img_url": "https://example.com/post.jpg",
+            }
+            for i in range(posts)
+        ])
+
+
+def measure(function):
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(timings) * 1000, peak / 1024 / 1024
+
+
+def run(posts, body_kb):
+    with tempfile.TemporaryDirectory() as directory:
+        main = load_app(directory)
+        seed(main, posts, body_kb)
+        client = main.app.test_client()
+
+        def old_home():
+            with main.app.test_request_context("/"):
+                all_posts = main.session.query(main.BlogPost).all()
+                main.render_template("index.html", posts=all_posts, year=main.CURRENT_YEAR)
+                main.session.remove()
+
+        def first_page():
+            client.get("/")
+
+        def deep_page():
+            client.get(f"/?before={posts // 2}")
+
+        print(f"{posts} posts, {body_kb} KB bodies")
+        print(f"{'listing':>28} {'median ms':>10} {'peak MB':>8}")
+        for name, function in (("all posts (old home)", old_home), ("first page", first_page), ("page in the middle", deep_page)):
+            milliseconds, megabytes = measure(function)
+            print(f"{name:>28} {milliseconds:>10.1f} {megabytes:>8.1f}")
+        main.engine.dispose()
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else POSTS, int(sys.argv[2]) if len(sys.argv) > 2 else BODY_KB)
@@ -0,0 +1,89 @@
+# Compares the ORM path (session.query(Cafe) + to_dict) with the column projection
+# path (cafe_serializer) used by the cafe API list routes.
+#
+# Run from the repository root:
+#   python benchmarks/cafe_serialization.py [rows ...]
+# The cafe API runs on a temporary copy of the database, cafes.db is not touched.
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+CAFE_API = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "RESTful-API", "cafe-api")
+SCALES = [10_000, 100_000]
+REPEAT = 5
+AREAS = ["Peckham", "Shoreditch", "Bermondsey", "Hackney", "Borough", "Barbican", "Clerkenwell", "London Bridge", "Whitechapel", "Bankside"]
+
+
+def load_app(directory):
+    # the app opens 'RESTful-API/cafe-api/cafes.db' relative to the working directory
+    os.makedirs(os.path.join(directory, "RESTful-API", "cafe-api"))
+    os.chdir(directory)
+    sys.path.insert(0, CAFE_API)
+    import main
+    return main
+
+
+def seed(main, rows):
+    table = main.Cafe.__table__
+    with main.engine.begin() as connection:
+        connection.execute(table.delete())
+        connection.execute(table.insert(), [
+            {
+                "name": f"Cafe {i}",
+                "map_url": f"https://www.google.com/maps/@51.{i % 10000:04d},-0.{i % 1000:03d},17z",
+                "img_url": f"https://example.com/cafe-{i}.jpg",
+                "location": AREAS[i % len(AREAS)],
+                "seats": "20-30",
+                "has_toilet": i % 2 == 0,
+                "has_wifi": i % 3 != 0,
+                "has_sockets": i % 5 != 0,
+                "can_take_calls": i % 7 == 0,
+                "coffee_price": f"£{2 + i % 100 / 100:.2f}",
+            }
+            for i in range(rows)
+        ])
+    main.search_index.load(main.engine)
+
+
+def measure(function):
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main_benchmark(scales):
+    with tempfile.TemporaryDirectory() as directory:
+        main = load_app(directory)
+        Cafe, session, serializer = main.Cafe, main.session, main.cafe_serializer
+
+        def orm_all():
+            return main.jsonify(cafes_list=[main.to_dict(cafe) for cafe in session.query(Cafe).all()])
+
+        def projected_all():
+            return main.jsonify(cafes_list=serializer.to_dicts(session.execute(serializer.select()).all()))
+
+        def orm_search():
+            return main.jsonify(cafes_list=[main.to_dict(cafe) for cafe in session.query(Cafe).filter_by(location="Peckham").all()])
+
+        def projected_search():
+            rows = main.search_index.search(session, serializer.select(), "Peckham", {})
+            return main.jsonify(cafes_list=serializer.to_dicts(rows))
+
+        print(f"{'rows':>8} {'route':>8} {'orm ms':>10} {'projected ms':>13} {'speedup':>8}")
+        for rows in scales:
+            seed(main, rows)
+            with main.app.app_context():
+                for route, orm, projected in (("/all", orm_all, projected_all), ("/search", orm_search, projected_search)):
+                    orm_ms, projected_ms = measure(orm), measure(projected)
+                    session.remove()
+                    print(f"{rows:>8} {route:>8} {orm_ms:>10.1f} {projected_ms:>13.1f} {orm_ms / projected_ms:>7.1f}x")
+        main.engine.dispose()
+
+
+if __name__ == "__main__":
+    main_benchmark([int(rows) for rows in sys.argv[1:]] or SCALES)
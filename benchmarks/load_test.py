@@ -0,0 +1,425 @@
+# Load test of the hot routes of every app.
+#
+# For each app a child process seeds a temporary database (same relative path
+# as the real one) with synthetic data, a second child runs the app on it in a
+# threaded WSGI server (werkzeug), and this process sends concurrent requests
+# to each route for --duration seconds. top-ten-movies talks to tmdb_stub.py
+# instead of The Movie Database. The report is JSON: per route the number of
+# requests, errors, throughput and p50/p95/p99 latency, and per app the peak
+# RSS of the server process. The real databases are not touched.
+#
+# Run from the repository root:
+#   python benchmarks/load_test.py [--apps cafe-api,my-blog,...] [--scale small|medium|large]
+#       [--concurrency 8] [--duration 5] [--output report.json]
+#       [--baseline benchmarks/baseline.json [--save-baseline]] [--tolerance 0.2]
+# With --baseline the report is compared with a stored one, and the exit status
+# is 1 when a route got slower (p99) or slower to serve (throughput) by more
+# than the tolerance; --save-baseline stores this run as the baseline instead.
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.join(REPOSITORY, "benchmarks")
+
+# rows of the main table of each app, by scale
+SCALES = {"small": 1_000, "medium": 10_000, "large": 100_000}
+CONCURRENCY = 8
+DURATION = 5.0
+WARMUP = 1.0
+TOLERANCE = 0.2
+TMDB_LATENCY = 0.05  # seconds per TMDB stub answer
+REQUEST_TIMEOUT = 60
+
+AREAS = ["Peckham", "Shoreditch", "Bermondsey", "Hackney", "Borough", "Barbican", "Clerkenwell", "London Bridge", "Whitechapel", "Bankside"]
+WORDS = ["lorem", "ipsum", "dolor", "amet", "consectetur", "adipiscing", "elit"]
+TITLES = ["Alien", "Heat", "Jaws", "Up", "Fargo", "Rocky", "Psycho", "Vertigo", "Casablanca", "Amelie"]
+EMAIL, PASSWORD = "user1@example.com", "benchmark password"
+
+
+# Apps
+# name -> directory of the app, working directory of the app (both relative to
+# the repository / the temp dir) and the folder of its database
+APPS = {
+    "cafe-api": ("RESTful-API/cafe-api", "", "RESTful-API/cafe-api"),
+    "my-blog": ("my-blog", "", "RESTful-API/my-blog"),
+    "library": ("library", "", "library"),
+    "top-ten-movies": ("top-ten-movies", "", "top-ten-movies"),
+    "authentication": ("authentication", "", "authentication"),
+    "coffee-and-wifi": ("WTForms/coffee-and-wifi", "WTForms", "WTForms/coffee-and-wifi"),
+}
+
+
+def routes(app, rows):
+    # (name, method, path or function(rng) -> path, form data, needs a logged in user)
+    if app == "cafe-api":
+        return [
+            ("/all first page", "GET", "/all?limit=100", None, False),
+            ("/all streamed", "GET", "/all", None, False),
+            ("/search", "GET", lambda rng: f"/search?area={rng.choice(AREAS)}&wifi=1", None, False),
+            ("/random", "GET", "/random", None, False),
+            ("/nearby", "GET", lambda rng: f"/nearby?lat=51.{rng.randint(0, 9999):04d}&lng=-0.{rng.randint(0, 999):03d}", None, False),
+        ]
+    if app == "my-blog":
+        return [
+            ("/ home", "GET", "/", None, False),
+            ("/ older page", "GET", f"/?before={rows // 2}", None, False),
+            ("/post", "GET", lambda rng: f"/post/{rng.randint(1, rows)}", None, False),
+            ("/search", "GET", lambda rng: f"/search?q={rng.choice(WORDS)}", None, False),
+        ]
+    if app == "library":
+        return [
+            ("/ home", "GET", "/", None, False),
+            ("/ by rating", "GET", "/?sort=rating&order=desc", None, False),
+            ("/ author filter", "GET", lambda rng: f"/?author=Author {rng.randint(0, 99)}&sort=title", None, False),
+            ("/ deep page", "GET", f"/?after={rows // 2}", None, False),
+        ]
+    if app == "top-ten-movies":
+        return [
+            ("/ home", "GET", "/", None, False),
+            ("/poster thumbnail", "GET", lambda rng: f"/poster/{rng.randint(1, rows)}?size=thumb", None, False),
+            ("/add search", "POST", "/add", lambda rng: {"title": rng.choice(TITLES)}, False),
+        ]
+    if app == "authentication":
+        return [
+            ("/ home", "GET", "/", None, False),
+            ("/secrets", "GET", "/secrets", None, True),
+            ("/login", "POST", "/login", lambda rng: {"email": EMAIL, "password": PASSWORD}, False),
+        ]
+    if app == "coffee-and-wifi":
+        return [
+            ("/cafes first page", "GET", "/cafes", None, False),
+            ("/cafes last page", "GET", f"/cafes?page={rows // 50 + 1}", None, False),
+        ]
+    raise ValueError(f"Unknown app {app}.")
+
+
+def table_rows(app, scale_rows):
+    # the number of rows seeded for an app
+    return {
+        "my-blog": scale_rows // 10,
+        "top-ten-movies": max(scale_rows // 100, 10),
+        "authentication": scale_rows // 10,
+    }.get(app, scale_rows)
+
+
+# Child processes: seeding and serving
+def load_app(app, directory):
+    app_directory, working_directory, database_folder = APPS[app]
+    os.makedirs(os.path.join(directory, database_folder), exist_ok=True)
+    os.chdir(os.path.join(directory, working_directory))
+    sys.path.insert(0, os.path.join(REPOSITORY, app_directory))
+    if app == "top-ten-movies":
+        # secret.py is not in the repository; the stub takes any token
+        with open(os.path.join(directory, "secret.py"), "w") as file:
+            file.write('TMDB_TOKEN = "benchmark"\n')
+        sys.path.append(directory)
+    import main
+    return main
+
+
+def seed(app, directory, rows):
+    rng = random.Random(0)
+    if app == "coffee-and-wifi":
+        # the app reads the CSV file when it starts - no need to import it
+        path = os.path.join(directory, "WTForms", "coffee-and-wifi", "cafe-data.csv")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf8") as file:
+            file.write("Cafe Name,Location,Open,Close,Coffee,Wifi,Power\n")
+            for i in range(rows):
+                file.write(f"Cafe {i},https://goo.gl/maps/{i},8AM,5PM,{'☕' * rng.randint(1, 5)},{'💪' * rng.randint(1, 5)},{'🔌' * rng.randint(1, 5)}\n")
+        return
+
+    main = load_app(app, directory)
+    with main.engine.begin() as connection:
+        if app == "cafe-api":
+            connection.execute(main.Cafe.__table__.insert(), [
+                {
+                    "name": f"Cafe {i}",
+                    "map_url": f"https://www.google.com/maps/@51.{rng.randint(0, 9999):04d},-0.{rng.randint(0, 999):03d},17z",
+                    "img_url": f"https://example.com/cafe-{i}.jpg",
+                    "location": AREAS[i % len(AREAS)],
+                    "seats": "20-30",
+                    "has_toilet": rng.random() < 0.5,
+                    "has_wifi": rng.random() < 0.7,
+                    "has_sockets": rng.random() < 0.5,
+                    "can_take_calls": rng.random() < 0.3,
+                    "coffee_price": f"£{rng.randint(2, 4)}.{rng.randint(0, 99):02d}",
+                }
+                for i in range(rows)
+            ])
+        elif app == "my-blog":
+            paragraph = "<p>" + " ".join(rng.choice(WORDS) for _ in range(120)) + "</p>"
+            connection.execute(main.BlogPost.__table__.insert(), [
+                {
+                    "title": f"Post number {i}",
+                    "subtitle": f"The subtitle of post {i}",
+                    "date": "January 01, 2024",
+                    "body": paragraph * 8,
+                    "author": "Liel",
+                    "img_url": "https://example.com/post.jpg",
+                }
+                for i in range(rows)
+            ])
+        elif app == "library":
+            connection.execute(main.Book.__table__.insert(), [
+                {"id": i, "title": f"Book {i}", "author": f"Author {rng.randint(0, 999)}", "parts": rng.randint(1, 7), "rating": rng.randint(0, 100) / 10}
+                for i in range(1, rows + 1)
+            ])
+        elif app == "top-ten-movies":
+            connection.execute(main.Movie.__table__.insert(), [
+                {
+                    "id": i, "title": f"Movie {i}", "year": 1950 + i % 70, "description": f"The story of movie {i}.",
+                    "rating": rng.randint(0, 100) / 10, "review": "Fine.", "img_url": f"{main.TMDB_IMAGE_URL}/poster-{i}.jpg",
+                }
+                for i in range(1, rows + 1)
+            ])
+        elif app == "authentication":
+            # one hash for everybody - hashing every user would take most of the run
+            from werkzeug.security import generate_password_hash
+            password = generate_password_hash(PASSWORD, main.PASSWORD_HASH_METHOD, main.PASSWORD_SALT_LENGTH)
+            connection.execute(main.User.__table__.insert(), [
+                {"email": f"user{i}@example.com", "password": password, "name": f"User {i}"}
+                for i in range(1, rows + 1)
+            ])
+    if app == "my-blog":
+        main.blog_search.rebuild(main.engine)
+    if app == "library":
+        main.create_sequence(main.engine, "books", rows + 1)
+    main.engine.dispose()
+
+
+def serve(app, directory, tmdb_latency):
+    if app == "top-ten-movies":
+        sys.path.insert(0, BENCHMARKS)
+        import tmdb_stub
+        stub = tmdb_stub.start(latency=tmdb_latency)
+        os.environ["TMDB_API_URL"] = f"http://127.0.0.1:{stub.server_port}/3"
+        os.environ["TMDB_IMAGE_URL"] = f"http://127.0.0.1:{stub.server_port}/t/p"
+    main = load_app(app, directory)
+
+    # keep the caches of the run in the temp dir, so every run starts cold
+    if app == "my-blog":
+        main.post_cache = main.PostCache(spill_dir=os.path.join(directory, "my-blog-posts"))
+    if app == "top-ten-movies":
+        main.app.config["WTF_CSRF_ENABLED"] = False
+        main.tmdb = main.TmdbClient(main.TMDB_TOKEN, base_url=os.environ["TMDB_API_URL"], cache_path=os.path.join(directory, "tmdb-cache.db"))
+        main.poster_store = main.PosterStore(os.path.join(directory, "posters"), image_url=os.environ["TMDB_IMAGE_URL"])
+
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # no line per request
+    server = make_server("127.0.0.1", 0, main.app, threaded=True)
+    # exit normally on terminate(), so that worker processes (the password hashing pool) are stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(server.server_port, flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        if app == "authentication":
+            main.hasher.shutdown()
+
+
+# Load
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))] if sorted_values else None
+
+
+def drive(url, route, concurrency, duration, seed=0):
+    name, method, path, data, login = route
+    deadline = time.perf_counter() + duration
+    results = [None] * concurrency
+
+    def worker(number):
+        rng = random.Random(seed * 1000 + number)
+        latencies, statuses = [], {}
+        with requests.Session() as http:
+            if login:
+                http.post(url + "/login", data={"email": EMAIL, "password": PASSWORD}, timeout=REQUEST_TIMEOUT)
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = http.request(method, url + (path(rng) if callable(path) else path),
+                                            data=data(rng) if data else None, allow_redirects=False, timeout=REQUEST_TIMEOUT)
+                    status = str(response.status_code)
+                except requests.RequestException as error:
+                    status = type(error).__name__
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+        results[number] = (latencies, statuses)
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for worker_latencies, _ in results for latency in worker_latencies)
+    statuses = {}
+    for _, worker_statuses in results:
+        for status, count in worker_statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    milliseconds = lambda seconds: None if seconds is None else round(seconds * 1000, 2)
+    return {
+        "requests": len(latencies),
+        "errors": sum(count for status, count in statuses.items() if not status.isdigit() or int(status) >= 400),
+        "statuses": statuses,
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "mean_ms": milliseconds(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": milliseconds(percentile(latencies, 0.50)),
+        "p95_ms": milliseconds(percentile(latencies, 0.95)),
+        "p99_ms": milliseconds(percentile(latencies, 0.99)),
+    }
+
+
+def peak_rss_mb(pid):
+    # VmHWM is the peak resident set size of the process (Linux only)
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def run_app(app, options):
+    rows = table_rows(app, SCALES[options.scale])
+    script = os.path.abspath(__file__)
+    with tempfile.TemporaryDirectory() as directory:
+        started = time.perf_counter()
+        subprocess.run([sys.executable, script, "--seed", app, "--directory", directory, "--rows", str(rows)], check=True, cwd=REPOSITORY)
+        seed_seconds = time.perf_counter() - started
+
+        server = subprocess.Popen([sys.executable, script, "--serve", app, "--directory", directory, "--tmdb-latency", str(options.tmdb_latency)],
+                                  stdout=subprocess.PIPE, text=True, cwd=REPOSITORY)
+        try:
+            port = server.stdout.readline().strip()
+            if not port:
+                raise RuntimeError(f"The {app} server didn't start.")
+            url = f"http://127.0.0.1:{port}"
+            report = {"rows": rows, "seed_seconds": round(seed_seconds, 2), "routes": {}}
+            for number, route in enumerate(routes(app, rows)):
+                log(f"{app} {route[0]} ...")
+                if options.warmup:
+                    drive(url, route, options.concurrency, options.warmup, seed=number + 100)
+                report["routes"][route[0]] = drive(url, route, options.concurrency, options.duration, seed=number)
+            report["peak_rss_mb"] = peak_rss_mb(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+    return report
+
+
+# Baseline
+def compare(report, baseline, tolerance):
+    # prints the changes per route; returns the regressions
+    regressions = []
+    log(f"{'app':>16} {'route':>20} {'p50 ms':>17} {'p99 ms':>17} {'req/s':>17}")
+    for app, app_report in report["apps"].items():
+        base_routes = baseline.get("apps", {}).get(app, {}).get("routes", {})
+        for route, result in app_report["routes"].items():
+            base = base_routes.get(route)
+            if base is None or not result["requests"] or not base["requests"]:
+                continue
+            cells = []
+            for key in ("p50_ms", "p99_ms", "throughput_rps"):
+                change = (result[key] - base[key]) / base[key] if base[key] else 0.0
+                cells.append(f"{base[key]:>7} {change:>+8.0%}")
+            log(f"{app:>16} {route:>20} {cells[0]:>17} {cells[1]:>17} {cells[2]:>17}")
+            if base["p99_ms"] and result["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+                regressions.append(f"{app} {route}: p99 {base['p99_ms']} -> {result['p99_ms']} ms")
+            if result["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+                regressions.append(f"{app} {route}: {base['throughput_rps']} -> {result['throughput_rps']} requests/s")
+    return regressions
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=REPOSITORY).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main_benchmark(options):
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "scale": options.scale,
+            "concurrency": options.concurrency,
+            "duration": options.duration,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "apps": {},
+    }
+    for app in options.apps.split(","):
+        report["apps"][app] = run_app(app, options)
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if options.output:
+        with open(options.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+    if options.baseline and options.save_baseline:
+        with open(options.baseline, "w") as file:
+            file.write(text + "\n")
+        log(f"Saved the baseline to {options.baseline}.")
+    elif options.baseline:
+        with open(options.baseline) as file:
+            regressions = compare(report, json.load(file), options.tolerance)
+        for regression in regressions:
+            log("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the apps of this repository.")
+    parser.add_argument("--apps", default=",".join(APPS), help="Comma separated, default: all of them.")
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--duration", type=float, default=DURATION, help="Seconds per route.")
+    parser.add_argument("--warmup", type=float, default=WARMUP, help="Seconds per route before measuring.")
+    parser.add_argument("--tmdb-latency", type=float, default=TMDB_LATENCY, help="Seconds per answer of the TMDB stub.")
+    parser.add_argument("--output", help="File of the JSON report (default: stdout).")
+    parser.add_argument("--baseline", help="JSON report to compare with.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as --baseline.")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="Allowed slowdown before a route is a regression.")
+    # used by the child processes
+    parser.add_argument("--seed", help=argparse.SUPPRESS)
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    parser.add_argument("--directory", help=argparse.SUPPRESS)
+    parser.add_argument("--rows", type=int, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.seed:
+        seed(options.seed, options.directory, options.rows)
+    elif options.serve:
+        serve(options.serve, options.directory, options.tmdb_latency)
+    else:
+        unknown = set(options.apps.split(",")) - set(APPS)
+        if unknown:
+            parser.error(f"Unknown apps: {', '.join(sorted(unknown))}.")
+        sys.exit(main_benchmark(options))
@@ -0,0 +1,85 @@
+# A local stand-in for The Movie Database API and image server, for running
+# top-ten-movies without the network:
+#   /3/search/movie?query=...  -> results with ids made from the query
+#   /3/movie/<id>              -> details of the movie
+#   /t/p/<size>/<poster>.jpg   -> a small fake image
+# Every answer waits `latency` seconds, like a request over the internet.
+#
+# Run from the repository root:
+#   python benchmarks/tmdb_stub.py [port]
+# then start the app with TMDB_API_URL=http://127.0.0.1:<port>/3
+# and TMDB_IMAGE_URL=http://127.0.0.1:<port>/t/p
+import hashlib
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+RESULTS_PER_SEARCH = 10
+IMAGE_BYTES = {"w500": 60_000, "w342": 25_000}
+
+
+class TmdbStubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        if url.path == "/3/search/movie":
+            query = parse_qs(url.query).get("query", [""])[0]
+            self.send_json({"page": 1, "results": [search_result(query, number) for number in range(RESULTS_PER_SEARCH)]})
+        elif url.path.startswith("/3/movie/") and url.path.rsplit("/", 1)[1].isdigit():
+            self.send_json(movie(int(url.path.rsplit("/", 1)[1])))
+        elif url.path.startswith("/t/p/"):
+            size = url.path.split("/")[3]
+            self.send(200, "image/jpeg", (url.path.encode() * 1000)[:IMAGE_BYTES.get(size, 10_000)])
+        else:
+            self.send_json({"status_message": "The resource you requested could not be found."}, 404)
+
+    def send_json(self, data, status=200):
+        self.send(status, "application/json", json.dumps(data).encode())
+
+    def send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def movie_id(query, number):
+    return int(hashlib.sha1(f"{query}:{number}".encode()).hexdigest()[:7], 16)
+
+
+def search_result(query, number):
+    return {"id": movie_id(query, number), "original_title": f"{query} {number + 1}", "release_date": f"{1980 + number}-01-01"}
+
+
+def movie(movie_id):
+    return {
+        "id": movie_id,
+        "original_title": f"Movie {movie_id}",
+        "release_date": f"{1950 + movie_id % 70}-06-01",
+        "overview": f"The story of movie {movie_id}.",
+        "poster_path": f"/poster-{movie_id}.jpg",
+    }
+
+
+def start(port=0, latency=0.0):
+    # serves in a background thread; returns the server (server.server_port, server.shutdown())
+    handler = type("Handler", (TmdbStubHandler,), {"latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    server = start(int(sys.argv[1]) if len(sys.argv) > 1 else 8765)
+    print(f"TMDB stub on http://127.0.0.1:{server.server_port}")
+    threading.Event().wait()
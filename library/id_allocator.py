@@ -0,0 +1,51 @@
+import threading
+
+from sqlalchemy import text
+
+
+# Hands out ids for new rows from a sequence table in the database.
+# allocate() reserves a block of block_size ids with one
+#   UPDATE id_sequences SET next_id = next_id + :block_size ... RETURNING next_id
+# (the UPDATE takes SQLite's write lock, so two processes never get the same
+# block) and next_id() gives them out one by one from memory. Ids of a block
+# that isn't used up before the app stops are skipped, never reused.
+class IdAllocator:
+    def __init__(self, engine, name, block_size=100):
+        self.engine = engine
+        self.name = name
+        self.block_size = block_size
+        self.next = self.end = 0  # the current block is [next, end)
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            if self.next >= self.end:
+                self.end = self.allocate()
+                self.next = self.end - self.block_size
+            self.next += 1
+            return self.next - 1
+
+    def allocate(self):
+        with self.engine.begin() as connection:
+            return reserve_ids(connection, self.name, self.block_size)
+
+
+def reserve_ids(connection, name, count):
+    # reserves count ids in the transaction of connection; returns the end of the
+    # block - the ids are range(end - count, end)
+    end = connection.execute(text(
+        "UPDATE id_sequences SET next_id = next_id + :count WHERE name = :name RETURNING next_id"
+    ), {"count": count, "name": name}).scalar()
+    if end is None:
+        raise LookupError(f"There is no id sequence '{name}' - call create_sequence() first.")
+    return end
+
+
+def create_sequence(engine, name, start):
+    # creates the sequence, or moves it forward to start - ids below start are never handed out
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE IF NOT EXISTS id_sequences (name TEXT PRIMARY KEY, next_id INTEGER NOT NULL)"))
+        connection.execute(text(
+            "INSERT INTO id_sequences (name, next_id) VALUES (:name, :start) "
+            "ON CONFLICT (name) DO UPDATE SET next_id = max(next_id, excluded.next_id)"
+        ), {"name": name, "start": start})
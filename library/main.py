@@ -1,12 +1,29 @@
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, redirect, url_for
+from flask.cli import AppGroup
+import click
 import sqlalchemy
-from sqlalchemy import create_engine, Column, Integer, String, Float
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy import Column, Integer, String, Float, func, select, tuple_
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # repository root, for the shared modules
+from shared.database import create_sqlite_engine, init_session
+from shared.instrumentation import init_instrumentation
+from shared.static_assets import init_static_assets
+from shared import bulk_io
+
+from id_allocator import IdAllocator, create_sequence, reserve_ids
+
+
+BOOKS_PER_PAGE = 50
+
 
 app = Flask(__name__)
+init_static_assets(app)  # fingerprinted static files, after 'flask build-static'
 
 # Create DataBase
-engine = create_engine('sqlite:///library/my-books-collection.db')
+engine = create_sqlite_engine('sqlite:///library/my-books-collection.db')
 Base = sqlalchemy.orm.declarative_base()
 
 # Note - We can see the DB in the DB Browser of "SQLite" that installed on our computer.
@@ -16,38 +33,71 @@ class Book(Base):
     __tablename__ = 'books'
     id = Column(Integer, primary_key=True)
     title = Column(String(250), unique=True, nullable=False)
-    author = Column(String(250), nullable=False)
+    author = Column(String(250), nullable=False, index=True)
     parts = Column(Integer, nullable=False)
-    rating = Column(Float, nullable=False)
+    rating = Column(Float, nullable=False, index=True)
 Base.metadata.create_all(engine)
+for index in Book.__table__.indexes:  # create_all() doesn't add indexes to an existing table
+    index.create(engine, checkfirst=True)
 
-Session = sessionmaker(bind=engine)
-session = Session()
+# the columns the book list can be sorted by (title is indexed by its unique constraint)
+SORT_COLUMNS = {"id": Book.id, "title": Book.title, "author": Book.author, "rating": Book.rating}
+PREFIX_FILTERS = {"title": Book.title, "author": Book.author}
 
-with open("library/id.txt", mode="r") as file:
-    counter = int(file.read())
+session = init_session(app, engine)
+init_instrumentation(app, engine)  # request timing, SQL statement counts and /metrics
+
+# ids of the new books (see id_allocator.py). The sequence starts after the
+# books in the table and after the last id of the old id.txt counter.
+with engine.connect() as connection:
+    first_id = (connection.execute(select(func.max(Book.id))).scalar() or 0) + 1
+if os.path.exists("library/id.txt"):
+    with open("library/id.txt", mode="r") as file:
+        first_id = max(first_id, int(file.read()) + 1)
+create_sequence(engine, "books", first_id)
+book_ids = IdAllocator(engine, "books")
 
 
 @app.route('/')
 def home():
-    all_books = session.query(Book).all()
-    return render_template('index.html', all_books=all_books)
+    # http://127.0.0.1:5000/?sort=rating&order=desc&author=<start of the name>&title=<start of the title>&after=<id of the last book of the previous page>
+    # One page of books. The page after a book starts right after it in the
+    # sort order (with the id breaking ties), so every page is an index range scan.
+    sort = request.args.get('sort', 'id')
+    if sort not in SORT_COLUMNS:
+        sort = 'id'
+    descending = request.args.get('order') == 'desc'
+    key = (SORT_COLUMNS[sort], Book.id) if sort != 'id' else (Book.id,)
+
+    query = session.query(Book)
+    filters = {}
+    for name, column in PREFIX_FILTERS.items():
+        prefix = request.args.get(name, '').strip()
+        if prefix:
+            # a range instead of LIKE 'prefix%', so that the index is used (case sensitive)
+            query = query.filter(column >= prefix, column < prefix + "\U0010ffff")
+            filters[name] = prefix
+
+    after = request.args.get('after', type=int)
+    last_book = session.get(Book, after) if after is not None else None
+    if last_book is not None:
+        last_key = tuple_(*(getattr(last_book, column.key) for column in key))
+        query = query.filter(tuple_(*key) < last_key if descending else tuple_(*key) > last_key)
+
+    books = query.order_by(*(column.desc() if descending else column for column in key)).limit(BOOKS_PER_PAGE + 1).all()
+    next_after = books[BOOKS_PER_PAGE - 1].id if len(books) > BOOKS_PER_PAGE else None
+    params = dict(filters, sort=sort, order='desc' if descending else 'asc')
+    return render_template('index.html', all_books=books[:BOOKS_PER_PAGE], params=params,
+                           next_after=next_after, is_first_page=last_book is None)
 
 @app.route("/add", methods=['GET', 'POST'])
 def add():
-    global counter
-
     if request.method == "POST":
         try:
-            counter += 1
-            # save the last used 'id' for next running.
-            with open("library/id.txt", mode="w") as file:
-                file.write(f"{counter}")
-
-            new_book = Book(id=counter, title=request.form['title'], author=request.form['author'], parts=request.form['parts'],rating=request.form['rating'])
+            new_book = Book(id=book_ids.next_id(), title=request.form['title'], author=request.form['author'], parts=request.form['parts'],rating=request.form['rating'])
             session.add(new_book)
             session.commit()
-            return home()
+            return redirect(url_for('home'))
         except:
             session.rollback()
             return render_template('error.html', message="This book already exists in your library.")
@@ -61,7 +111,7 @@ def edit():
         try:
             book.rating = request.form['new_rating']
             session.commit()
-            return home()
+            return redirect(url_for('home'))
         except:
             session.rollback()
             return render_template('error.html', message="Rating must be a number.")
@@ -74,7 +124,120 @@ def delete():
     book = session.query(Book).filter_by(id=book_id).first()
     session.delete(book)
     session.commit()
-    return home()
+    return redirect(url_for('home'))
+
+
+# CLI commands
+# flask --app library/main library import <file> / library export <file>
+library_cli = AppGroup("library", help="Import and export the books.")
+BOOK_FIELDS = ("id", "title", "author", "parts", "rating")
+ON_CONFLICT = ("skip", "update")
+COMMIT_EVERY = 100_000  # rows per transaction
+EXPORT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 10
+
+def parse_book(data):
+    # the values of one book from a file row - raises ValueError when invalid. The id is given by the sequence.
+    if not isinstance(data, dict):
+        raise ValueError("A book must be a JSON object.")
+    book = {}
+    for field in ("title", "author"):
+        value = data.get(field)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError(f"{field} is missing.")
+        book[field] = value.strip()
+    try:
+        book["parts"] = int(data.get("parts"))
+        book["rating"] = float(data.get("rating"))
+    except (TypeError, ValueError):
+        raise ValueError("parts and rating must be numbers.")
+    return book
+
+@library_cli.command("import")
+@click.argument("path")
+@click.option("--format", "format", type=click.Choice(bulk_io.FORMATS), help="Default: from the extension.")
+@click.option("--on-conflict", type=click.Choice(ON_CONFLICT), default="skip", show_default=True,
+              help="What to do with a book whose title is already stored.")
+@click.option("--commit-every", type=int, default=COMMIT_EVERY, show_default=True, help="Rows per transaction.")
+def import_books(path, format, on_conflict, commit_every):
+    """Load books from a CSV or NDJSON file ("-" reads stdin)."""
+    try:
+        file_format = bulk_io.file_format(path, format)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    statement = insert(Book.__table__)
+    if on_conflict == "skip":
+        statement = statement.on_conflict_do_nothing(index_elements=["title"])
+    else:
+        statement = statement.on_conflict_do_update(
+            index_elements=["title"],
+            set_={field: statement.excluded[field] for field in ("author", "parts", "rating")},
+        )
+    counts = bulk_io.import_counts()
+    progress = bulk_io.Progress("library import")
+
+    with bulk_io.open_file(path, "r") as file, engine.connect() as connection:
+        uncommitted = 0
+        try:
+            for chunk in bulk_io.chunks(enumerate(bulk_io.read_rows(file, file_format), 1)):
+                books = []
+                for row_number, data in chunk:
+                    try:
+                        books.append(parse_book(data))
+                    except ValueError as error:
+                        counts["invalid"] += 1
+                        if counts["invalid"] <= MAX_REPORTED_ERRORS:
+                            click.echo(f"Row {row_number}: {error}", err=True)
+                if books:
+                    titles = [book["title"] for book in books]
+                    existing = set(connection.execute(select(Book.title).where(Book.title.in_(titles))).scalars())
+                    # the ids come from the same sequence as add(), reserved in this transaction
+                    end = reserve_ids(connection, "books", len(books))
+                    for book_id, book in zip(range(end - len(books), end), books):
+                        book["id"] = book_id
+                    connection.execute(statement, books)  # one executemany per chunk
+                    for title in titles:
+                        if title in existing:
+                            counts["updated" if on_conflict == "update" else "skipped"] += 1
+                        else:
+                            counts["created"] += 1
+                            existing.add(title)  # the same title again in this file is a conflict
+                uncommitted += len(chunk)
+                if uncommitted >= commit_every:
+                    connection.commit()
+                    uncommitted = 0
+                progress.add(len(chunk))
+            connection.commit()
+        except ValueError as error:  # a line that is not JSON
+            connection.rollback()
+            raise click.ClickException(f"{error} The rows after the last commit were not imported.")
+    progress.done(bulk_io.import_summary(counts))
+    return counts
+
+@library_cli.command("export")
+@click.argument("path")
+@click.option("--format", "format", type=click.Choice(bulk_io.FORMATS), help="Default: from the extension.")
+def export_books(path, format):
+    """Write all the books to a CSV or NDJSON file ("-" writes stdout)."""
+    try:
+        file_format = bulk_io.file_format(path, format)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    progress = bulk_io.Progress("library export")
+
+    with engine.connect() as connection, bulk_io.open_file(path, "w") as file:
+        statement = select(*(Book.__table__.c[field] for field in BOOK_FIELDS)).order_by(Book.id)
+        result = connection.execution_options(yield_per=EXPORT_BATCH_SIZE).execute(statement)
+
+        def rows():
+            for partition in result.partitions():
+                yield from partition
+                progress.add(len(partition))
+
+        bulk_io.write_rows(file, rows(), BOOK_FIELDS, file_format)
+    progress.done()
+
+app.cli.add_command(library_cli)
 
 
 if __name__ == "__main__":
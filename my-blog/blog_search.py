@@ -0,0 +1,98 @@
+import html
+import re
+
+from markupsafe import Markup, escape
+from sqlalchemy import inspect, text
+
+
+# Full-text search over the posts with SQLite FTS5.
+# blog_post_fts holds a copy of title, subtitle, body and author of every post
+# (rowid = post id), with the HTML tags of the CKEditor body removed so that
+# they are neither searchable nor shown in the snippets. The routes that create,
+# edit or delete a post update it in the same transaction.
+FTS_TABLE = "blog_post_fts"
+HIGHLIGHT_START, HIGHLIGHT_END = "\x02", "\x03"  # replaced by <mark> after escaping the snippet
+REBUILD_BATCH_SIZE = 1000
+
+TAG = re.compile(r"<[^>]*>")
+
+
+def create_index(engine):
+    # creates the index of an existing posts.db and fills it; returns True when it was created
+    if inspect(engine).has_table(FTS_TABLE):
+        return False
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(title, subtitle, body, author, tokenize='porter unicode61')"
+        ))
+    rebuild(engine)
+    return True
+
+
+def rebuild(engine):
+    with engine.begin() as connection:
+        connection.execute(text(f"DELETE FROM {FTS_TABLE}"))
+        posts = connection.execution_options(yield_per=REBUILD_BATCH_SIZE).execute(
+            text("SELECT id, title, subtitle, body, author FROM blog_post")
+        )
+        count = 0
+        for partition in posts.partitions():
+            connection.execute(text(
+                f"INSERT INTO {FTS_TABLE} (rowid, title, subtitle, body, author) VALUES (:id, :title, :subtitle, :body, :author)"
+            ), [document(*row) for row in partition])
+            count += len(partition)
+    return count
+
+
+def strip_html(body):
+    return " ".join(html.unescape(TAG.sub(" ", body)).split())
+
+
+def document(post_id, title, subtitle, body, author):
+    return {"id": post_id, "title": title, "subtitle": subtitle, "body": strip_html(body), "author": author}
+
+
+# Incremental maintenance - call before the commit of the post change
+def index_post(session, post):
+    remove_post(session, post.id)
+    session.execute(text(
+        f"INSERT INTO {FTS_TABLE} (rowid, title, subtitle, body, author) VALUES (:id, :title, :subtitle, :body, :author)"
+    ), document(post.id, post.title, post.subtitle, post.body, post.author))
+
+
+def remove_post(session, post_id):
+    session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), {"id": post_id})
+
+
+# Searching
+def match_expression(query):
+    # every word must appear; words are quoted so the FTS5 query syntax ("-", "*", NEAR...) can't break the query
+    words = re.findall(r"\w+", query)
+    return " ".join('"' + word + '"' for word in words)
+
+
+def search(session, query, page=1, per_page=10):
+    # returns (results, total number of matching posts), best matches first
+    expression = match_expression(query)
+    if not expression:
+        return [], 0
+
+    total = session.execute(text(f"SELECT count(*) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :query"),
+                            {"query": expression}).scalar()
+    rows = session.execute(text(f"""
+        SELECT p.id, p.title, p.subtitle, p.author, p.date,
+               snippet({FTS_TABLE}, 2, :start, :end, '…', 24) AS snippet
+        FROM {FTS_TABLE} JOIN blog_post AS p ON p.id = {FTS_TABLE}.rowid
+        WHERE {FTS_TABLE} MATCH :query
+        ORDER BY bm25({FTS_TABLE}, 10.0, 5.0, 1.0, 2.0)
+        LIMIT :limit OFFSET :offset
+    """), {
+        "query": expression, "start": HIGHLIGHT_START, "end": HIGHLIGHT_END,
+        "limit": per_page, "offset": (page - 1) * per_page,
+    }).mappings().all()
+    return [{**row, "snippet": highlight(row["snippet"])} for row in rows], total
+
+
+def highlight(snippet):
+    escaped = str(escape(snippet))
+    return Markup(escaped.replace(HIGHLIGHT_START, "<mark>").replace(HIGHLIGHT_END, "</mark>"))
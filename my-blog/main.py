@@ -1,4 +1,4 @@
-from flask import Flask, render_template, redirect, url_for, request
+from flask import Flask, render_template, redirect, url_for, request, make_response, abort
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor, CKEditorField
 from flask_wtf import FlaskForm
@@ -6,22 +6,36 @@ from wtforms import StringField, SubmitField
 from wtforms.validators import DataRequired, URL
 
 import sqlalchemy
-from sqlalchemy import create_engine, Column, Integer, String, Text
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, String, Text, select, text
+from sqlalchemy.orm import defer
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # repository root, for the shared modules
+from shared.database import create_sqlite_engine, init_session
+from shared.instrumentation import init_instrumentation
+from shared.static_assets import init_static_assets
 
 import datetime
+import time
+
+from post_cache import PostCache
+import blog_search
 
 
 CURRENT_YEAR = datetime.date.today().year
+POSTS_PER_PAGE = 10
+SEARCH_RESULTS_PER_PAGE = 10
 
 app = Flask(__name__)
 ckeditor = CKEditor(app) # text editor
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = '8BYkEfBA6O6donzWlSihBXox7C0sKR6a'
 Bootstrap(app)
+init_static_assets(app)  # fingerprinted static files, after 'flask build-static'
 
 # Create DataBase
-engine = create_engine('sqlite:///RESTful-API/my-blog/posts.db')
+engine = create_sqlite_engine('sqlite:///RESTful-API/my-blog/posts.db')
 Base = sqlalchemy.orm.declarative_base()
 
 # NOTE: We can see the DB in the DB Browser of "SQLite" that installed on our computer:
@@ -37,10 +51,21 @@ class BlogPost(Base):
     body = Column(Text, nullable=False)
     author = Column(String(250), nullable=False)
     img_url = Column(String(250), nullable=False)
+    # changes with every write of the post (the time of the write in ns, so a new post
+    # that gets the id of a deleted one has a new version too) - see post_cache.py
+    version = Column(Integer, nullable=False, default=time.time_ns, onupdate=time.time_ns)
 
 Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-session = Session()
+# create_all() skips existing tables, so add the new column to an older posts.db here.
+if 'version' not in [column['name'] for column in sqlalchemy.inspect(engine).get_columns(BlogPost.__tablename__)]:
+    with engine.begin() as connection:
+        connection.execute(text(f"ALTER TABLE {BlogPost.__tablename__} ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+blog_search.create_index(engine)  # indexes the existing posts the first time
+session = init_session(app, engine)
+init_instrumentation(app, engine)  # request timing, SQL statement counts and /metrics
+
+# rendered post pages, by post version.
+post_cache = PostCache(spill_dir=os.path.join(app.instance_path, "post-cache"))
 
 # WTForms - Configure CreatePostForm form
 class CreatePostForm(FlaskForm):
@@ -57,8 +82,15 @@ class CreatePostForm(FlaskForm):
 # GET HTTP
 @app.route('/')
 def home():
-    posts = session.query(BlogPost).all()
-    return render_template("index.html", posts=posts, year=CURRENT_YEAR)
+    # http://127.0.0.1:5000/?before=<id of the last post of the previous page>
+    # newest posts first. The body is not shown in the list, so it isn't loaded.
+    before = request.args.get('before', type=int)
+    query = session.query(BlogPost).options(defer(BlogPost.body)).order_by(BlogPost.id.desc())
+    if before is not None:
+        query = query.filter(BlogPost.id < before)
+    posts = query.limit(POSTS_PER_PAGE + 1).all()
+    older = posts[POSTS_PER_PAGE - 1].id if len(posts) > POSTS_PER_PAGE else None
+    return render_template("index.html", posts=posts[:POSTS_PER_PAGE], older=older, is_first_page=before is None, year=CURRENT_YEAR)
 
 @app.route('/about')
 def about():
@@ -66,8 +98,31 @@ def about():
 
 @app.route('/post/<int:post_id>')
 def view_post(post_id):
-    post = session.query(BlogPost).get(post_id)
-    return render_template("post.html", post=post, year=CURRENT_YEAR)
+    version = session.execute(select(BlogPost.version).where(BlogPost.id == post_id)).scalar()
+    if version is None:
+        abort(404)
+    page = post_cache.get(post_id, version)
+    if page is None:
+        post = session.query(BlogPost).get(post_id)
+        if post is None:
+            abort(404)
+        page = post_cache.put(post_id, post.version, render_template("post.html", post=post, year=CURRENT_YEAR))
+
+    response = make_response(page.html)
+    response.set_etag(page.etag)
+    if page.last_modified is not None:  # setting None would send the current time
+        response.last_modified = page.last_modified
+    return response.make_conditional(request)
+
+@app.route('/search')
+def search():
+    # http://127.0.0.1:5000/search?q=<words>&page=<page number>
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    results, total = blog_search.search(session, query, page, SEARCH_RESULTS_PER_PAGE)
+    num_of_pages = -(-total // SEARCH_RESULTS_PER_PAGE)
+    return render_template("search.html", query=query, results=results, total=total,
+                           page=page, num_of_pages=num_of_pages, year=CURRENT_YEAR)
 
 
 # POST HTTP
@@ -94,7 +149,10 @@ def create_post():
             img_url = request.form.get("img_url")
         )
         session.add(new_post)
+        session.flush()  # gives new_post its id
+        blog_search.index_post(session, new_post)
         session.commit()
+        post_cache.invalidate(new_post.id)
         return redirect(url_for('home'))
     return render_template("make-post.html", form=form, is_edit = False)
 
@@ -116,7 +174,9 @@ def edit_post(post_id):
         post.body = request.form.get("body")
         post.author = request.form.get("author")
         post.img_url = request.form.get("img_url")
+        blog_search.index_post(session, post)
         session.commit()
+        post_cache.invalidate(post_id)
         return redirect(url_for('view_post', post_id=post_id))
 
     return render_template("make-post.html", form=edit_form, is_edit = True)
@@ -124,11 +184,20 @@ def edit_post(post_id):
 @app.route('/delete/<int:post_id>', methods=["POST", "GET"])
 def delete_post(post_id):
     session.query(BlogPost).filter_by(id=post_id).delete()
+    blog_search.remove_post(session, post_id)
     session.commit()
+    post_cache.invalidate(post_id)
     return redirect(url_for('home'))
 
 # NOTE: HTML forms do not accept PUT, PATCH or DELETE methods. So while the last two methods would normally be a PUT/DELETE requests, because the request is coming from a HTML form, we define them as a POST requests.
 
 
+# CLI commands
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index():
+    """Index all the posts again (flask --app my-blog/main rebuild-search-index)."""
+    print(f"Indexed {blog_search.rebuild(engine)} posts.")
+
+
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+
+RenderedPost = namedtuple("RenderedPost", ["version", "html", "etag", "last_modified"])
+
+
+def modified_time(version):
+    # version: time_ns() of the last write of the post, 0 if unknown
+    return version / 1e9 if version else None
+
+
+# Cache of the rendered post pages.
+# Every post has a version stored in the database, which changes with every
+# write of the post; a cached page is only used while its version is the
+# current one, so the processes sharing the database never serve an old page.
+# The pages are kept in an LRU bounded by their total size. Pages pushed out of
+# memory are written to spill_dir (if given) as <post id>/<version>.html and read
+# back from there on the next hit, so only the first view of a post after an
+# edit renders it again. The files stay valid across restarts and can be shared
+# by the workers of an instance.
+# The version is the time_ns() of the last write, so it is also the
+# Last-Modified of the page (posts from before the version column have 0 and
+# get no Last-Modified - the ETag still works for them).
+class PostCache:
+    def __init__(self, max_bytes=16 * 1024 * 1024, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()  # post id -> RenderedPost
+        self.size = 0
+        self.lock = threading.Lock()
+
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def invalidate(self, post_id):
+        # frees the pages of a post after a write of this process - they would
+        # not be used anyway, since the write changed the version
+        with self.lock:
+            if post_id in self.entries:
+                self.drop(post_id)
+        if self.spill_dir is None:
+            return
+        # only the directory of this post - it holds the few versions of the post
+        # spilled since the last write
+        post_dir = os.path.join(self.spill_dir, str(post_id))
+        try:
+            file_names = os.listdir(post_dir)
+        except FileNotFoundError:
+            return
+        for file_name in file_names:
+            try:
+                os.remove(os.path.join(post_dir, file_name))
+            except FileNotFoundError:  # removed by another worker, or an unfinished spill was renamed
+                pass
+
+    def get(self, post_id, version):
+        with self.lock:
+            entry = self.entries.get(post_id)
+            if entry is not None and entry.version == version:
+                self.entries.move_to_end(post_id)
+                return entry
+
+        entry = self.read_spilled(post_id, version)
+        if entry is not None:
+            self.store(post_id, entry)
+        return entry
+
+    def put(self, post_id, version, html):
+        html = html.encode() if isinstance(html, str) else html
+        entry = RenderedPost(version, html, hashlib.sha1(html).hexdigest(), modified_time(version))
+        self.store(post_id, entry)
+        return entry
+
+    def store(self, post_id, entry):
+        spilled = []
+        with self.lock:
+            if post_id in self.entries:
+                self.drop(post_id)
+            self.entries[post_id] = entry
+            self.size += len(entry.html)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old_id = next(iter(self.entries))
+                spilled.append((old_id, self.entries[old_id]))
+                self.drop(old_id)
+        for old_id, old_entry in spilled:
+            self.spill(old_id, old_entry)
+
+    def drop(self, post_id):
+        self.size -= len(self.entries.pop(post_id).html)
+
+    # Disk
+    def spill_path(self, post_id, version):
+        return os.path.join(self.spill_dir, str(post_id), f"{version}.html")
+
+    def spill(self, post_id, entry):
+        if self.spill_dir is None:
+            return
+        path = self.spill_path(post_id, entry.version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"  # other workers may spill the same page
+        try:
+            with open(temporary_path, "wb") as file:
+                file.write(entry.html)
+            os.replace(temporary_path, path)
+        except FileNotFoundError:
+            pass  # the post was written meanwhile and invalidate() removed the file - the page is old anyway
+
+    def read_spilled(self, post_id, version):
+        if self.spill_dir is None:
+            return None
+        path = self.spill_path(post_id, version)
+        try:
+            with open(path, "rb") as file:
+                html = file.read()
+        except FileNotFoundError:
+            return None
+        return RenderedPost(version, html, hashlib.sha1(html).hexdigest(), modified_time(version))
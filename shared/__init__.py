@@ -0,0 +1 @@
+# Helpers shared by the Flask apps of this repository.
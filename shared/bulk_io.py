@@ -0,0 +1,103 @@
+import csv
+import json
+import sys
+import time
+
+
+# Streaming CSV / NDJSON files for the import and export CLI commands.
+# Rows are read and written one at a time (dicts keyed by column name), and
+# the writes are grouped with chunks(), so a file of any size is loaded or
+# dumped in constant memory.
+FORMATS = ("csv", "ndjson")
+EXTENSIONS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+CHUNK_SIZE = 1000
+IMPORT_STATUSES = ("created", "updated", "skipped", "invalid")
+
+
+def file_format(path, format=None):
+    # the format given on the command line, else the one of the file extension
+    if format:
+        return format
+    for extension, name in EXTENSIONS.items():
+        if path.lower().endswith(extension):
+            return name
+    raise ValueError(f"Can't tell the format of {path} - use --format ({' or '.join(FORMATS)}).")
+
+
+def open_file(path, mode):
+    # "-" is stdin / stdout; newline="" lets the csv module handle line endings inside values
+    if path == "-":
+        return open(sys.stdout.fileno() if "w" in mode else sys.stdin.fileno(), mode, encoding="utf8", newline="", closefd=False)
+    return open(path, mode, encoding="utf8", newline="")
+
+
+def read_rows(file, format):
+    if format == "csv":
+        yield from csv.DictReader(file)
+        return
+    for line_number, line in enumerate(file, 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                raise ValueError(f"Line {line_number} is not valid JSON.")
+
+
+def write_rows(file, rows, fields, format):
+    # rows are sequences of values in the order of fields; returns the number of rows written
+    count = 0
+    if format == "csv":
+        writer = csv.writer(file, lineterminator="\n")
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in rows:
+            file.write(json.dumps(dict(zip(fields, row)), ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def import_counts():
+    # rows of an import by status
+    return dict.fromkeys(IMPORT_STATUSES, 0)
+
+
+def import_summary(counts):
+    return " - " + ", ".join(f"{counts[status]} {status}" for status in IMPORT_STATUSES)
+
+
+def chunks(rows, size=CHUNK_SIZE):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Prints how many rows were done, at most every `interval` seconds (to stderr,
+# so that an export to stdout stays clean).
+class Progress:
+    def __init__(self, label, interval=1.0, echo=None):
+        self.label = label
+        self.interval = interval
+        self.echo = echo or (lambda message: print(message, file=sys.stderr))
+        self.count = 0
+        self.started = self.printed = time.monotonic()
+
+    def add(self, count):
+        self.count += count
+        now = time.monotonic()
+        if now - self.printed >= self.interval:
+            self.printed = now
+            self.echo(f"{self.label}: {self.count} rows ({self.rate():.0f} rows/s)")
+
+    def rate(self):
+        return self.count / max(time.monotonic() - self.started, 1e-9)
+
+    def done(self, summary=""):
+        self.echo(f"{self.label}: {self.count} rows in {time.monotonic() - self.started:.1f} s{summary}")
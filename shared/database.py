@@ -0,0 +1,51 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+
+# SQLite settings applied to every new connection.
+# WAL lets readers work while a writer commits, NORMAL sync is safe with WAL,
+# and busy_timeout makes a writer wait for the lock instead of failing at once.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 268435456,  # 256 MB
+    "cache_size": -64000,  # negative value = size in KB, so 64 MB
+    "busy_timeout": 5000,  # ms
+    "temp_store": "MEMORY",
+}
+
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+
+
+def create_sqlite_engine(url, pragmas=None, **kwargs):
+    engine = create_engine(
+        url,
+        pool_size=kwargs.pop("pool_size", POOL_SIZE),
+        max_overflow=kwargs.pop("max_overflow", MAX_OVERFLOW),
+        # connections are handed between the threads of the server by the pool
+        connect_args={"check_same_thread": False},
+        **kwargs
+    )
+    settings = {**SQLITE_PRAGMAS, **(pragmas or {})}
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in settings.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return engine
+
+
+def init_session(app, engine):
+    # One session per thread (= per request), removed when the request ends,
+    # so uncommitted work or a failed transaction never leaks into the next request.
+    session = scoped_session(sessionmaker(bind=engine))
+
+    @app.teardown_appcontext
+    def remove_session(exception=None):
+        session.remove()
+
+    return session
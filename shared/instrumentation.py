@@ -0,0 +1,238 @@
+import bisect
+import threading
+import time
+from collections import Counter
+
+from flask import Response, g, has_request_context, request
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+
+
+# Request and SQL metrics of an app, served in the Prometheus text format at /metrics.
+#
+# init_instrumentation(app, engine) records for every endpoint:
+#   - the number of requests by method and status, and a latency histogram
+#     (measured until the last byte of the body, so streamed responses count in full)
+#   - the bytes of the responses (generated bodies are counted as they are sent;
+#     files use their Content-Length, so the server can still sendfile them)
+#   - the SQL statements run during the request and their time, and a histogram
+#     of statements per request
+#   - the time spent rendering templates
+# and logs a warning for a statement slower than SLOW_QUERY_SECONDS and for a
+# request that runs the same statement N_PLUS_ONE_THRESHOLD times or more
+# (usually a query in a loop - an N+1). Statements run outside of a request
+# (background loads, CLI commands) are counted under the endpoint "(none)".
+# The cost is a few dictionary updates per request and per statement.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SLOW_QUERY_SECONDS = 0.1
+N_PLUS_ONE_THRESHOLD = 10
+NO_ENDPOINT = "(none)"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+# What one request did - kept in flask.g while it runs
+class RequestStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.render_seconds = 0.0
+        self.render_start = None
+        self.statements = Counter()
+        self.streamed_bytes = 0
+        self.response = None  # a direct_passthrough response, recorded at teardown
+
+
+class Metrics:
+    def __init__(self, app, count_queries=True):
+        self.app = app
+        self.count_queries = count_queries
+        self.lock = threading.Lock()
+        self.requests = Counter()  # (endpoint, method, status) -> requests
+        self.latency = {}  # endpoint -> Histogram
+        self.queries_per_request = {}  # endpoint -> Histogram
+        self.response_bytes = Counter()
+        self.queries = Counter()
+        self.query_seconds = Counter()
+        self.render_seconds = Counter()
+        self.slow_queries = Counter()
+        self.n_plus_one = Counter()
+        self.warned_n_plus_one = set()  # (endpoint, statement) already logged
+
+    # Flask hooks
+    def start_request(self):
+        g.request_stats = RequestStats()
+
+    def end_request(self, response):
+        stats = g.get("request_stats")
+        if stats is None:
+            return response
+        endpoint = request.endpoint or NO_ENDPOINT
+        method = request.method
+        if response.direct_passthrough:
+            # a file (send_file) is handed to the server as it is - wrapping it would lose
+            # wsgi.file_wrapper - and werkzeug never calls close() on it, so end_teardown records it
+            stats.response = response
+            return response
+        if response.is_streamed:
+            response.response = self.count_bytes(response.response, stats)
+        # recorded when the body is sent: call_on_close runs after the last chunk of a stream
+        response.call_on_close(lambda: self.record(stats, endpoint, method, response))
+        return response
+
+    def end_teardown(self, exception=None):
+        stats = g.get("request_stats")
+        if stats is not None and stats.response is not None:
+            self.record(stats, request.endpoint or NO_ENDPOINT, request.method, stats.response)
+
+    def count_bytes(self, chunks, stats):
+        for chunk in chunks:
+            stats.streamed_bytes += len(chunk)
+            yield chunk
+
+    def record(self, stats, endpoint, method, response):
+        seconds = time.perf_counter() - stats.start
+        repeated = [(statement, count) for statement, count in stats.statements.items() if count >= N_PLUS_ONE_THRESHOLD]
+        with self.lock:
+            self.requests[(endpoint, method, str(response.status_code))] += 1
+            self.latency.setdefault(endpoint, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            if self.count_queries:
+                self.queries_per_request.setdefault(endpoint, Histogram(QUERY_COUNT_BUCKETS)).observe(stats.queries)
+            if response.is_streamed and not response.direct_passthrough:
+                self.response_bytes[endpoint] += stats.streamed_bytes
+            else:
+                self.response_bytes[endpoint] += response.content_length or 0
+            self.render_seconds[endpoint] += stats.render_seconds
+            if repeated:
+                self.n_plus_one[endpoint] += 1
+            new_warnings = []
+            for statement, count in repeated:
+                if (endpoint, statement) not in self.warned_n_plus_one:
+                    self.warned_n_plus_one.add((endpoint, statement))
+                    new_warnings.append((statement, count))
+        for statement, count in new_warnings:
+            self.app.logger.warning("Possible N+1 in %s: the same statement ran %d times in one request: %s",
+                                    endpoint, count, shorten(statement))
+
+    def start_render(self, sender, template, context, **extra):
+        stats = g.get("request_stats") if has_request_context() else None
+        if stats is not None:
+            stats.render_start = time.perf_counter()
+
+    def end_render(self, sender, template, context, **extra):
+        stats = g.get("request_stats") if has_request_context() else None
+        if stats is not None and stats.render_start is not None:
+            stats.render_seconds += time.perf_counter() - stats.render_start
+            stats.render_start = None
+
+    # SQLAlchemy hooks
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.query_start = time.perf_counter()
+
+    def after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "query_start", None)
+        seconds = time.perf_counter() - start if start is not None else 0.0
+        stats = g.get("request_stats") if has_request_context() else None
+        if stats is not None:
+            stats.queries += 1
+            stats.query_seconds += seconds
+            stats.statements[statement] += 1
+            endpoint = request.endpoint or NO_ENDPOINT
+        else:
+            endpoint = NO_ENDPOINT
+        with self.lock:
+            self.queries[endpoint] += 1
+            self.query_seconds[endpoint] += seconds
+            if seconds >= SLOW_QUERY_SECONDS:
+                self.slow_queries[endpoint] += 1
+        if seconds >= SLOW_QUERY_SECONDS:
+            self.app.logger.warning("Slow query in %s (%.0f ms): %s", endpoint, seconds * 1000, shorten(statement))
+
+    # Prometheus text format
+    def render(self):
+        lines = []
+        with self.lock:
+            add_metric(lines, "http_requests_total", "counter", "Requests by endpoint, method and status.",
+                       ((dict(endpoint=endpoint, method=method, status=status), count)
+                        for (endpoint, method, status), count in sorted(self.requests.items())))
+            add_histogram(lines, "http_request_duration_seconds", "Time to answer a request, until its last byte.", self.latency)
+            add_metric(lines, "http_response_bytes_total", "counter", "Bytes of the response bodies.",
+                       by_endpoint(self.response_bytes))
+            add_metric(lines, "db_queries_total", "counter", "SQL statements run.", by_endpoint(self.queries))
+            add_metric(lines, "db_query_seconds_total", "counter", "Time spent running SQL statements.", by_endpoint(self.query_seconds))
+            add_histogram(lines, "db_queries_per_request", "SQL statements run by one request.", self.queries_per_request)
+            add_metric(lines, "db_slow_queries_total", "counter", f"SQL statements slower than {SLOW_QUERY_SECONDS} s.",
+                       by_endpoint(self.slow_queries))
+            add_metric(lines, "db_n_plus_one_total", "counter",
+                       f"Requests that ran the same statement {N_PLUS_ONE_THRESHOLD} times or more.", by_endpoint(self.n_plus_one))
+            add_metric(lines, "template_render_seconds_total", "counter", "Time spent rendering templates.",
+                       by_endpoint(self.render_seconds))
+        return "\n".join(lines) + "\n"
+
+
+def init_instrumentation(app, engine=None):
+    metrics = Metrics(app, count_queries=engine is not None)
+    app.before_request(metrics.start_request)
+    app.after_request(metrics.end_request)
+    app.teardown_request(metrics.end_teardown)
+    before_render_template.connect(metrics.start_render, app, weak=False)
+    template_rendered.connect(metrics.end_render, app, weak=False)
+    if engine is not None:
+        event.listen(engine, "before_cursor_execute", metrics.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", metrics.after_cursor_execute)
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    return metrics
+
+
+# Formatting
+def shorten(statement, length=300):
+    statement = " ".join(statement.split())
+    return statement if len(statement) <= length else statement[:length] + "..."
+
+
+def by_endpoint(counter):
+    return ((dict(endpoint=endpoint), value) for endpoint, value in sorted(counter.items()))
+
+
+def labels(values):
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(values, escaped)) + "}"
+
+
+def number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def add_metric(lines, name, kind, help, samples):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} {kind}")
+    for sample_labels, value in samples:
+        lines.append(f"{name}{labels(sample_labels)} {number(value)}")
+
+
+def add_histogram(lines, name, help, histograms):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} histogram")
+    for endpoint, histogram in sorted(histograms.items()):
+        total = 0
+        for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+            total += count
+            lines.append(f"{name}_bucket{labels(dict(endpoint=endpoint, le=bound))} {total}")
+        lines.append(f"{name}_sum{labels(dict(endpoint=endpoint))} {number(histogram.sum)}")
+        lines.append(f"{name}_count{labels(dict(endpoint=endpoint))} {total}")
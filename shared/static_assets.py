@@ -0,0 +1,136 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+
+from flask import request, send_from_directory
+
+
+# Fingerprinted, precompressed static files.
+#
+# build() copies every file of the static folder to static/build/ under a name
+# that contains a hash of its content (css/styles.css -> css/styles.1a2b3c4d5e6f.css),
+# adds a .gz copy of the text files and writes manifest.json (original name ->
+# hashed name). url() references inside CSS files are pointed at the hashed files.
+#
+# init_static_assets(app) makes url_for('static', filename=...) return the hashed
+# name when it is in the manifest, and serves the hashed files with a one year
+# "immutable" Cache-Control (a new content gets a new name) and the .gz copy to
+# clients that accept gzip. Without a build the app serves the original files.
+BUILD_DIR = "build"
+MANIFEST = "manifest.json"
+HASH_LENGTH = 12
+COMPRESSIBLE = {".css", ".js", ".svg", ".html", ".txt", ".json", ".ico", ".map", ".xml"}
+MIN_COMPRESS_SIZE = 512
+ONE_YEAR = 365 * 24 * 3600
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+# Build step
+def build(static_folder):
+    build_folder = os.path.join(static_folder, BUILD_DIR)
+    shutil.rmtree(build_folder, ignore_errors=True)
+
+    files = []
+    for folder, sub_folders, file_names in os.walk(static_folder):
+        if os.path.abspath(folder) == os.path.abspath(static_folder):
+            sub_folders[:] = [name for name in sub_folders if name != BUILD_DIR]
+        for file_name in file_names:
+            path = os.path.relpath(os.path.join(folder, file_name), static_folder)
+            files.append(path.replace(os.sep, "/"))
+
+    manifest = {}
+    # CSS last, so that its url() references can use the hashed names of the other files
+    for path in sorted(files, key=lambda path: path.endswith(".css")):
+        with open(os.path.join(static_folder, path), "rb") as file:
+            content = file.read()
+        if path.endswith(".css"):
+            content = rewrite_css_urls(content, path, manifest)
+
+        digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+        root, extension = posixpath.splitext(path)
+        hashed_path = f"{root}.{digest}{extension}"
+        manifest[path] = f"{BUILD_DIR}/{hashed_path}"
+
+        target = os.path.join(build_folder, hashed_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as file:
+            file.write(content)
+        if extension.lower() in COMPRESSIBLE and len(content) >= MIN_COMPRESS_SIZE:
+            compressed = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(compressed) < len(content):
+                with open(target + ".gz", "wb") as file:
+                    file.write(compressed)
+
+    with open(os.path.join(build_folder, MANIFEST), "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return manifest
+
+
+def rewrite_css_urls(content, css_path, manifest):
+    css_folder = posixpath.dirname(css_path)
+
+    def replace(match):
+        quote, url = match.groups()
+        if ":" in url or url.startswith(("/", "#")):  # external, data: or absolute
+            return match.group(0)
+        path, _, suffix = url.partition("?")
+        target = posixpath.normpath(posixpath.join(css_folder, path))
+        if target not in manifest:
+            return match.group(0)
+        # both files move under build/, so the relative path keeps working
+        hashed = posixpath.relpath(manifest[target][len(BUILD_DIR) + 1:], css_folder or ".")
+        return f"url({quote}{hashed}{'?' + suffix if suffix else ''}{quote})"
+
+    return CSS_URL.sub(replace, content.decode("utf8")).encode("utf8")
+
+
+# Runtime
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, BUILD_DIR, MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def init_static_assets(app):
+    manifest = load_manifest(app.static_folder)
+    hashed_files = set(manifest.values())
+    serve_original = app.view_functions["static"]
+
+    @app.url_defaults
+    def hashed_static_url(endpoint, values):
+        if endpoint == "static" and values.get("filename") in manifest:
+            values["filename"] = manifest[values["filename"]]
+
+    def static(filename):
+        if filename not in hashed_files:
+            return serve_original(filename=filename)
+
+        gzipped = os.path.exists(os.path.join(app.static_folder, filename + ".gz"))
+        if gzipped and request.accept_encodings.quality("gzip") > 0:
+            response = send_from_directory(app.static_folder, filename + ".gz", max_age=ONE_YEAR)
+            response.headers["Content-Encoding"] = "gzip"
+            response.mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        else:
+            response = send_from_directory(app.static_folder, filename, max_age=ONE_YEAR)
+        if gzipped:
+            response.vary.add("Accept-Encoding")
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    app.view_functions["static"] = static
+
+    @app.cli.command("build-static")
+    def build_static():
+        """Write the fingerprinted and gzipped copies of the static files."""
+        print(f"Built {len(build(app.static_folder))} static files into {os.path.join(app.static_folder, BUILD_DIR)}.")
+
+    return manifest
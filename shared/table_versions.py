@@ -0,0 +1,33 @@
+from sqlalchemy import bindparam, text
+
+
+# A version number per table, stored in the database.
+# Triggers bump it on every INSERT / UPDATE / DELETE, in the transaction of the
+# write, whoever makes it (another worker, a CLI command, the sqlite3 shell).
+# The caches and in-memory indexes of an app remember the version they were
+# built from and compare it with table_version() - one primary key lookup - to
+# notice the writes of the other processes.
+OPERATIONS = ("INSERT", "UPDATE", "DELETE")
+
+
+def create_table_versions(engine, *tables):
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE IF NOT EXISTS table_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)"))
+        for table in tables:
+            connection.execute(text("INSERT OR IGNORE INTO table_versions (name, version) VALUES (:name, 0)"), {"name": table})
+            for operation in OPERATIONS:
+                connection.execute(text(
+                    f"CREATE TRIGGER IF NOT EXISTS {table}_version_{operation.lower()} AFTER {operation} ON {table} "
+                    f"BEGIN UPDATE table_versions SET version = version + 1 WHERE name = '{table}'; END"
+                ))
+
+
+def table_version(connection, table):
+    # connection: a Connection or a Session
+    return connection.execute(text("SELECT version FROM table_versions WHERE name = :name"), {"name": table}).scalar()
+
+
+def tables_version(connection, tables):
+    # one number that changes with every write to any of the tables (the versions only grow)
+    statement = text("SELECT sum(version) FROM table_versions WHERE name IN :names").bindparams(bindparam("names", expanding=True))
+    return connection.execute(statement, {"names": list(tables)}).scalar()
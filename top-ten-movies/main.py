@@ -1,18 +1,29 @@
-from flask import Flask, render_template, redirect, url_for, request
+from flask import Flask, render_template, redirect, url_for, request, send_file, abort
 from flask_bootstrap import Bootstrap
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, FloatField
 from wtforms.validators import DataRequired
 
 import sqlalchemy
-from sqlalchemy import create_engine, Column, Integer, String, Float
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, func
+from sqlalchemy.exc import IntegrityError
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # repository root, for the shared modules
+from shared.database import create_sqlite_engine, init_session
+from shared.instrumentation import init_instrumentation
+from shared.table_versions import create_table_versions, tables_version
+
+import tempfile
 
 import requests
 from secret import TMDB_TOKEN # access token auth for 'The Movie Data Base' website.
+from tmdb_client import TmdbClient, TMDB_API_URL
+from poster_store import PosterStore, PosterQueue, TMDB_IMAGE_BASE_URL
 
-TMDB_MOVIE_URL = "https://api.themoviedb.org/3/movie"
 TMDB_IMAGE_URL = "https://image.tmdb.org/t/p/w500"
+POSTER_MAX_AGE = 365 * 24 * 3600  # for the /poster URLs that carry the content hash
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = '8BYkEfBA6O6donzWlSihBXox7C0sKR6b'
@@ -20,7 +31,7 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 Bootstrap(app)
 
 # Create DataBase
-engine = create_engine('sqlite:///top-ten-movies/movies.db')
+engine = create_sqlite_engine('sqlite:///top-ten-movies/movies.db')
 Base = sqlalchemy.orm.declarative_base()
 
 # Note - We can see the DB in the DB Browser of "SQLite" that installed on our computer:
@@ -38,10 +49,34 @@ class Movie(Base):
     review = Column(String(250), nullable=True)
     img_url = Column(String(250), nullable=False)
 
+# The posters downloaded by find() - one row per size, the file is in poster_store
+class Poster(Base):
+    __tablename__ = 'posters'
+    movie_id = Column(Integer, ForeignKey('movies.id'), primary_key=True)
+    size = Column(String(10), primary_key=True)
+    digest = Column(String(64), nullable=False)
+    mimetype = Column(String(50), nullable=False)
+
 Base.metadata.create_all(engine)
+# versions of the tables shown on the home page, bumped by every write - in any process
+create_table_versions(engine, Movie.__tablename__, Poster.__tablename__)
+
+session = init_session(app, engine)
+init_instrumentation(app, engine)  # request timing, SQL statement counts and /metrics
 
-Session = sessionmaker(bind=engine)
-session = Session()
+# 'The Movie Data Base' API - TMDB_API_URL can point the app at a local stub server
+tmdb = TmdbClient(
+    TMDB_TOKEN,
+    base_url=os.environ.get("TMDB_API_URL", TMDB_API_URL),
+    cache_path=os.path.join(tempfile.gettempdir(), "top-ten-movies-tmdb.db"),
+)
+
+# local copies of the posters, served by /poster/<id>
+poster_store = PosterStore(os.path.join(app.root_path, "posters"), image_url=os.environ.get("TMDB_IMAGE_URL", TMDB_IMAGE_BASE_URL))
+
+# the rendered home page and the version of the movies and posters it shows -
+# a write to either table (by any worker) makes the next view render it again.
+home_page = {"cached": None}
 
 
 class RateMovieForm(FlaskForm):
@@ -58,11 +93,21 @@ class AddMovieForm(FlaskForm):
 # All app routes below.
 @app.route("/")
 def home():
-    all_movies = session.query(Movie).all()
-    for i in range(len(all_movies)):
-        all_movies[i].ranking = len(all_movies) - i
-    session.commit()
-    return render_template("index.html", all_movies=all_movies)
+    version = tables_version(session, (Movie.__tablename__, Poster.__tablename__))
+    cached = home_page["cached"]
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    # the ranking is computed by the query (best rating = 1, unrated movies last),
+    # so showing the page is only a read. The cards count down to number 1.
+    ranking = func.row_number().over(order_by=(Movie.rating.desc().nulls_last(), Movie.id)).label("ranking")
+    all_movies = session.query(
+        Movie.id, Movie.title, Movie.year, Movie.description, Movie.rating, Movie.review, Movie.img_url, ranking,
+        Poster.digest.label("thumb")
+    ).outerjoin(Poster, (Poster.movie_id == Movie.id) & (Poster.size == "thumb")).order_by(ranking.desc()).all()
+    page = render_template("index.html", all_movies=all_movies)
+    home_page["cached"] = (version, page)
+    return page
 
 
 @app.route("/edit", methods=["GET", "POST"])
@@ -84,31 +129,102 @@ def edit():
 def delete():
     movie_id = request.args.get('id')
     movie = session.query(Movie).filter_by(id=movie_id).first()
+    posters = session.query(Poster).filter_by(movie_id=movie_id).all()
+    for poster in posters:
+        session.delete(poster)
     session.delete(movie)
     session.commit()
+    remove_poster_files(posters)
     return redirect(url_for('home'))
 
 
+@app.route("/poster/<int:movie_id>")
+def poster(movie_id):
+    # http://127.0.0.1:5000/poster/<movie id>?size=thumb&v=<start of the content hash>
+    size = request.args.get('size', 'full')
+    if size not in poster_store.sizes:
+        abort(404)
+    row = session.get(Poster, (movie_id, size))
+    if row is None:
+        # movies added before the posters were stored locally - TMDB serves the image
+        # while the posters are downloaded in the background (or by 'flask download-posters')
+        movie = session.get(Movie, movie_id)
+        if movie is None:
+            abort(404)
+        poster_queue.submit(movie.id)
+        return redirect(movie.img_url)
+
+    # a URL with the content hash changes with the image, so it can be cached for good;
+    # without it the browser checks the ETag every time (movie ids are reused)
+    versioned = bool(request.args.get('v')) and row.digest.startswith(request.args['v'])
+    response = send_file(poster_store.path(row.digest, row.mimetype), mimetype=row.mimetype, etag=False,
+                         max_age=POSTER_MAX_AGE if versioned else None)
+    response.set_etag(row.digest)
+    if versioned:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
+def save_posters(movie_id, poster_path):
+    # returns False when the posters couldn't be downloaded (the page then uses TMDB's URL)
+    try:
+        posters = poster_store.download(poster_path)
+    except (requests.RequestException, ValueError) as error:
+        app.logger.warning("Couldn't download the poster %s: %s", poster_path, error)
+        return False
+    old_posters = session.query(Poster).filter_by(movie_id=movie_id).all()
+    for poster in old_posters:
+        session.delete(poster)
+    session.flush()
+    for size, (digest, mimetype) in posters.items():
+        session.add(Poster(movie_id=movie_id, size=size, digest=digest, mimetype=mimetype))
+    try:
+        session.commit()
+    except IntegrityError:  # another request stored the posters of this movie first
+        session.rollback()
+        return True
+    remove_poster_files(old_posters)
+    return True
+
+
+def download_posters(movie_id):
+    # runs on a poster_queue thread, with the session of that thread
+    try:
+        movie = session.get(Movie, movie_id)
+        return movie is not None and save_posters(movie.id, movie.img_url.removeprefix(TMDB_IMAGE_URL))
+    except Exception:
+        app.logger.exception("Couldn't save the posters of movie %s", movie_id)
+        return False
+    finally:
+        session.remove()
+
+
+# posters of the movies added before they were stored locally, downloaded off the request path
+poster_queue = PosterQueue(download_posters)
+
+
+def remove_poster_files(posters):
+    # a file can belong to more than one movie - keep it while a row still points at it
+    for poster in posters:
+        if session.query(Poster).filter_by(digest=poster.digest).first() is None:
+            poster_store.remove(poster.digest, poster.mimetype)
+
+
 @app.route("/add", methods=["GET", "POST"])
 def add():
     add_movie_form = AddMovieForm()
 
     if add_movie_form.validate_on_submit():
         movie_title = add_movie_form.title.data
-        url = f"https://api.themoviedb.org/3/search/movie?query={movie_title}&language=en-US&page=1"
-        headers = {
-            "accept": "application/json",
-            "Authorization": f"Bearer {TMDB_TOKEN}"
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-
-        all_results = response.json()['results']
+        try:
+            all_results = tmdb.search(movie_title)
+        except requests.RequestException:
+            return render_template('error.html', message="Sorry, we couldn't reach The Movie Database. Try again later.")
         if all_results == []:
             return render_template('error.html', message="Sorry, we couldn't find that movie.")    
         return render_template("select.html", all_results=all_results)
     
-    from sqlalchemy import func
     rows = session.query(func.count(Movie.id)).scalar()
     if rows == 10:
         return render_template('error.html', message="Can't add more movies. You have 10 on your list.")
@@ -117,13 +233,13 @@ def add():
 
 @app.route("/find")
 def find():
-    movie_id = request.args.get('id')
-    url = f"{TMDB_MOVIE_URL}/{movie_id}"
-    headers = {
-        "accept": "application/json",
-        "Authorization": f"Bearer {TMDB_TOKEN}"
-    }
-    movie = requests.get(url, headers=headers).json() # get the movie details from 'TMBD' website
+    movie_id = request.args.get('id', type=int)
+    if movie_id is None:
+        return render_template('error.html', message="Sorry, we couldn't find that movie.")
+    try:
+        movie = tmdb.movie(movie_id) # get the movie details from 'TMBD' website
+    except requests.RequestException:
+        return render_template('error.html', message="Sorry, we couldn't reach The Movie Database. Try again later.")
     new_movie = Movie(
         title = movie['original_title'],
         year = movie['release_date'][:4],
@@ -138,9 +254,21 @@ def find():
         return render_template('error.html', message="This movie is already on your list.")
     
     # find the id of the movie that was created
+    poster_path = movie['poster_path']
     movie = session.query(Movie).filter_by(title=movie['original_title']).first()
+    if poster_path:
+        save_posters(movie.id, poster_path)  # keep a copy of the poster, once
     return redirect(url_for('edit', id=movie.id))
 
 
+# CLI commands
+@app.cli.command("download-posters")
+def download_missing_posters():
+    """Download the posters of the movies that have none (flask --app top-ten-movies/main download-posters)."""
+    movies = session.query(Movie).filter(~Movie.id.in_(session.query(Poster.movie_id))).all()
+    saved = sum(save_posters(movie.id, movie.img_url.removeprefix(TMDB_IMAGE_URL)) for movie in movies)
+    print(f"Downloaded the posters of {saved} of {len(movies)} movies.")
+
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
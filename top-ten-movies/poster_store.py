@@ -0,0 +1,107 @@
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+TMDB_IMAGE_BASE_URL = "https://image.tmdb.org/t/p"
+# poster variants: name -> TMDB image size. The card grid only needs the
+# thumbnail; TMDB resizes the images, so no imaging library is needed here.
+POSTER_SIZES = {"full": "w500", "thumb": "w342"}
+TIMEOUT = (3.05, 15)
+MAX_POSTER_BYTES = 5 * 1024 * 1024
+
+
+# Stores the movie posters on disk, named by the sha256 of their content
+# (folder/ab/abcdef....jpg), so each image is kept once and its name can be
+# used as an ETag and in "immutable" URLs. download() fetches every size of
+# a poster and returns {size name: (digest, mimetype)}.
+class PosterStore:
+    def __init__(self, folder, image_url=TMDB_IMAGE_BASE_URL, sizes=POSTER_SIZES):
+        self.folder = folder
+        self.image_url = image_url.rstrip("/")
+        self.sizes = sizes
+        self.session = requests.Session()
+        adapter = HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        os.makedirs(folder, exist_ok=True)
+
+    def download(self, poster_path):
+        # raises requests.RequestException or ValueError when a size can't be downloaded
+        return {name: self.store(self.fetch(f"{self.image_url}/{size}{poster_path}")) for name, size in self.sizes.items()}
+
+    def fetch(self, url):
+        with self.session.get(url, timeout=TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            mimetype = response.headers.get("Content-Type", "").split(";")[0].strip()
+            if not mimetype.startswith("image/"):
+                raise ValueError(f"{url} is not an image ({mimetype or 'no content type'}).")
+            content = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                content += chunk
+                if len(content) > MAX_POSTER_BYTES:
+                    raise ValueError(f"{url} is larger than {MAX_POSTER_BYTES} bytes.")
+        return bytes(content), mimetype
+
+    def store(self, fetched):
+        content, mimetype = fetched
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.path(digest, mimetype)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as file:
+                file.write(content)
+            os.replace(path + ".tmp", path)
+        return digest, mimetype
+
+    def path(self, digest, mimetype):
+        extension = mimetypes.guess_extension(mimetype) or ""
+        return os.path.join(self.folder, digest[:2], digest + extension)
+
+    def remove(self, digest, mimetype):
+        try:
+            os.remove(self.path(digest, mimetype))
+        except FileNotFoundError:
+            pass
+
+
+# Downloads posters in the background, one job per movie at a time.
+# download(movie_id) returns True when the posters were saved. A movie whose
+# download failed is not tried again for retry_after seconds, so during a TMDB
+# outage a page view doesn't start the same slow, failing downloads again.
+class PosterQueue:
+    def __init__(self, download, workers=2, retry_after=300):
+        self.download = download
+        self.retry_after = retry_after
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="posters")
+        self.pending = set()
+        self.failed = {}  # movie id -> time.monotonic() of the next attempt
+        self.lock = threading.Lock()
+
+    def submit(self, movie_id):
+        # returns False when the movie is already queued or failed recently
+        with self.lock:
+            if movie_id in self.pending or self.failed.get(movie_id, 0) > time.monotonic():
+                return False
+            self.pending.add(movie_id)
+        self.executor.submit(self.run, movie_id)
+        return True
+
+    def run(self, movie_id):
+        saved = False
+        try:
+            saved = self.download(movie_id)
+        finally:
+            with self.lock:
+                self.pending.discard(movie_id)
+                if saved:
+                    self.failed.pop(movie_id, None)
+                else:
+                    self.failed[movie_id] = time.monotonic() + self.retry_after
@@ -0,0 +1,170 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+TMDB_API_URL = "https://api.themoviedb.org/3"
+TIMEOUT = (3.05, 10)  # seconds to connect, seconds to read
+RETRIES = 3
+BACKOFF = 0.5  # 0.5 s, 1 s, 2 s between the retries
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+CACHE_TTL = 24 * 3600
+MEMORY_CACHE_SIZE = 256
+PREFETCH = 5  # details fetched ahead for the first search results
+
+
+# Client of The Movie Database API.
+# All the requests go through one requests.Session, so the TLS connections are
+# kept open and reused, with a timeout and retries (with backoff) on connection
+# errors, 429 and 5xx. The JSON answers are cached in memory (LRU) and in an
+# SQLite file (cache_path) for ttl seconds, so a repeated search or a restart
+# doesn't call the API again. search() also fetches the details of the first
+# results in the background - the ones the user is most likely to pick.
+# base_url can point at a local stub server for tests and benchmarks.
+class TmdbClient:
+    def __init__(self, token, base_url=TMDB_API_URL, cache_path=None, ttl=CACHE_TTL,
+                 memory_size=MEMORY_CACHE_SIZE, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF,
+                 prefetch=PREFETCH, workers=4):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.prefetch = prefetch
+
+        self.session = requests.Session()
+        self.session.headers.update({"accept": "application/json", "Authorization": f"Bearer {token}"})
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=["GET"], respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=workers + 4, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.memory = MemoryCache(memory_size, ttl)
+        self.disk = DiskCache(cache_path, ttl) if cache_path else None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tmdb-prefetch")
+        self.inflight = {}  # cache key -> Future of the request that is fetching it
+        self.lock = threading.Lock()
+
+    # API
+    def search(self, title):
+        results = self.get("/search/movie", {"query": title, "language": "en-US", "page": 1})["results"]
+        for result in results[:self.prefetch]:
+            self.executor.submit(self.quietly, self.movie, result["id"])
+        return results
+
+    def movie(self, movie_id):
+        return self.get(f"/movie/{int(movie_id)}")
+
+    # Cached GET
+    def get(self, path, params=None):
+        key = path + ("?" + urlencode(sorted(params.items())) if params else "")
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                value, expires = entry
+                self.memory.put(key, value, expires)
+                return value
+
+        # one request per key - a search and the prefetch of the same movie share it
+        with self.lock:
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            response = self.session.get(self.base_url + path, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            value = response.json()
+            self.memory.put(key, value)
+            if self.disk is not None:
+                self.disk.put(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    @staticmethod
+    def quietly(function, *args):
+        try:
+            function(*args)
+        except requests.RequestException:
+            pass  # a prefetch is only a guess - the real request reports its own error
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+        if self.disk is not None:
+            self.disk.close()
+
+
+# In-memory LRU with an expiry time per entry
+class MemoryCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expiry time, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value, expires=None):
+        with self.lock:
+            self.entries[key] = (expires or time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+# SQLite file of JSON answers with an expiry time, shared by the runs of the app
+class DiskCache:
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS tmdb_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+        self.connection.execute("DELETE FROM tmdb_cache WHERE expires <= ?", (time.time(),))
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # returns (value, expiry time) or None
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, expires FROM tmdb_cache WHERE key = ? AND expires > ?", (key, time.time())
+            ).fetchone()
+        return None if row is None else (json.loads(row[0]), row[1])
+
+    def put(self, key, value):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO tmdb_cache (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + self.ttl),
+            )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()